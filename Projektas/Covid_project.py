@@ -1,9 +1,22 @@
-import dash
-from dash import Dash, dcc, html, Input, Output, State
-from pymongo import MongoClient
+from startup_timing import timed, report
+with timed('import dash and pymongo'):
+    import dash
+    from dash import Dash, dcc, html, Input, Output, State
+    from pymongo import MongoClient
 from datetime import datetime
 import uuid
 import json
+from lazy_data import warm_up, start_refresh, datasets
+from comment_queue import CommentWriter, list_comments
+from country_index import country_index
+from export import register_export_routes
+from metrics import register_mongo_listener, register_metrics_routes, register_stats, instrument_callbacks
+import queue
+import forecasting
+from query_results import get_result_store
+from rollup import get_rollup
+from snowflake_pool import get_pool, get_sql_pool
+from worker_processes import in_worker_process
 
 with open('config.json') as f:
     config = json.load(f)
@@ -15,14 +28,33 @@ comment_schema = {
     'created_at': datetime,
 }
 
-client = MongoClient(f"mongodb+srv://{config['MONGO_USERNAME']}:{config['MONGO_PASSWORD']}@{config['MONGO_CLUSTER']}"
-                     f"/?retryWrites=true&w=majority")
+# Every MongoDB command is timed, created clients pick the listener up
+register_mongo_listener()
+
+with timed('create mongodb client'):
+    client = MongoClient(f"mongodb+srv://{config['MONGO_USERNAME']}:{config['MONGO_PASSWORD']}@{config['MONGO_CLUSTER']}"
+                         f"/?retryWrites=true&w=majority")
 db = client['Covid']
 collection = db['Comments']
 
+# Comments are written in batches by a background thread
+comment_writer = CommentWriter(
+    collection,
+    batch_size=config.get('COMMENT_BATCH_SIZE', 100),
+    flush_interval=config.get('COMMENT_FLUSH_INTERVAL', 1.0),
+    max_queue=config.get('COMMENT_QUEUE_SIZE', 10000),
+    max_retries=config.get('COMMENT_WRITE_RETRIES', 3),
+)
+# Process pool workers import this module again when it is the script being run, without the background jobs
+if not in_worker_process():
+    comment_writer.start()
+
 external_css = ['https://cdn.jsdelivr.net/npm/bootstrap@5.3.1/dist/css/bootstrap.min.css']
 
-app = Dash(__name__, pages_folder='pages', use_pages=True, external_stylesheets=external_css)
+with timed('create app and import pages'):
+    # gzip responses (flask-compress), on by default with the client-side payload
+    app = Dash(__name__, pages_folder='pages', use_pages=True, external_stylesheets=external_css,
+               compress=config.get('COMPRESS_RESPONSES', config.get('CLIENTSIDE_COUNTRY_SWITCHING', False)))
 
 app.layout = html.Div(children=[
     html.Nav(
@@ -48,6 +80,28 @@ app.layout = html.Div(children=[
     style={'max-width': 'none'}
 )
 
+register_export_routes(app.server)
+
+# Callback, query and cache metrics in Prometheus format at /metrics
+instrument_callbacks(app)
+register_metrics_routes(app.server)
+register_stats('comment_writer', lambda: dict(comment_writer.stats, depth=comment_writer.depth))
+register_stats('snowflake_pool', lambda: get_pool().stats)
+register_stats('sql_pool', lambda: get_sql_pool().stats)
+register_stats('sql_cache', lambda: get_result_store().cache.stats)
+register_stats('forecast_engine', lambda: forecasting.engine.stats)
+register_stats('rollup', lambda: get_rollup().stats if get_rollup() is not None else {})
+for dataset in datasets():
+    register_stats('dataset_' + dataset.name.lower().replace(' ', '_'), lambda dataset=dataset: dataset.stats)
+
+if not in_worker_process():
+    # Page datasets are built in the background, the server can answer requests right away
+    warm_up(on_done=lambda: print(report()))
+    # Page datasets with a refresh interval are rebuilt in the background and swapped in when ready
+    start_refresh()
+    # The country dropdown's list is loaded before the first page view asks for it
+    country_index.preload()
+
 
 # Handle comment submission
 @app.callback(
@@ -62,10 +116,34 @@ def handle_comment_submit(n_clicks, comment_text):
             'text': comment_text,
             'created_at': datetime.now(),
         }
-        collection.insert_one(new_comment)
+        try:
+            comment_writer.submit(new_comment)
+        except queue.Full:
+            # writer is falling behind, keep the text so the user can submit again
+            return dash.no_update
 
     return ''
 
 
+# Paginated comments, newest first: /api/comments?limit=20&before=2024-01-26T12:00:00
+@app.server.route('/api/comments')
+def comments_page():
+    from flask import abort, jsonify, request
+
+    try:
+        limit = int(request.args.get('limit', 20))
+        before = request.args.get('before')
+        before = datetime.fromisoformat(before) if before else None
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    comments = list_comments(collection, limit=min(limit, 100), before=before)
+    for comment in comments:
+        comment['created_at'] = comment['created_at'].isoformat()
+    return jsonify(comments)
+
+
 if __name__ == '__main__':
+    print(report())
     app.run_server(debug=True, port = 8888)
\ No newline at end of file
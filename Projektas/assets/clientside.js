@@ -0,0 +1,153 @@
+// Browser-side country switching for the main page (CLIENTSIDE_COUNTRY_SWITCHING in config.json).
+// The server sends every country's series once per page load; see client_payload.py for the format.
+(function () {
+    var DAY_MS = 86400000;
+    var CASE_TYPES = ['Confirmed', 'Deaths', 'Active', 'Recovered'];
+    // same colours as trace_colors in pages/main.py
+    var COLORS = {Confirmed: [99, 110, 250], Deaths: [239, 85, 59], Active: [0, 204, 150], Recovered: [171, 99, 250]};
+    var KPI_STYLE = {textAlign: 'center', color: 'white', fontWeight: 'bold', fontSize: '25px'};
+    var decoded = {version: null, countries: {}};
+
+    function typedArray(encoded) {
+        var binary = atob(encoded.data);
+        var bytes = new Uint8Array(binary.length);
+        for (var i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return encoded.dtype === 'int32' ? new Int32Array(bytes.buffer) : new Float64Array(bytes.buffer);
+    }
+
+    function cumulative(array) {
+        var out = new Float64Array(array.length);
+        var total = 0;
+        for (var i = 0; i < array.length; i++) {
+            total += array[i];
+            out[i] = total;
+        }
+        return out;
+    }
+
+    function isoDate(day) {
+        return new Date(day * DAY_MS).toISOString().slice(0, 10);
+    }
+
+    function decodeSeries(encoded) {
+        var days = cumulative(typedArray(encoded.dates));
+        var values = typedArray(encoded.values);
+        return {
+            days: days,
+            dates: Array.prototype.map.call(days, isoDate),
+            values: Array.from(encoded.values.delta ? cumulative(values) : values),
+        };
+    }
+
+    // The forecast and its band start at the last observed day
+    function decodeForecast(base, encoded) {
+        var lastDay = base.days[base.days.length - 1];
+        var lastValue = base.values[base.values.length - 1];
+        var values = Array.from(typedArray(encoded.values));
+        return {
+            dates: [base.dates[base.dates.length - 1]].concat(
+                values.map(function (_, i) { return isoDate(lastDay + i + 1); })),
+            values: [lastValue].concat(values),
+            lower: [lastValue].concat(Array.from(typedArray(encoded.lower))),
+            upper: [lastValue].concat(Array.from(typedArray(encoded.upper))),
+            fallback: encoded.fallback,
+        };
+    }
+
+    // Each country is decoded on first use and kept until the payload changes
+    function country(payload, name) {
+        if (decoded.version !== payload.version) {
+            decoded = {version: payload.version, countries: {}};
+        }
+        if (!(name in decoded.countries)) {
+            var encoded = payload.countries[name];
+            var series = {};
+            CASE_TYPES.forEach(function (caseType) {
+                series[caseType] = decodeSeries(encoded[caseType]);
+            });
+            series.forecasts = {};
+            Object.keys(encoded.forecasts || {}).forEach(function (caseType) {
+                series.forecasts[caseType] = decodeForecast(series[caseType], encoded.forecasts[caseType]);
+            });
+            decoded.countries[name] = series;
+        }
+        return decoded.countries[name];
+    }
+
+    function kpi(label, total) {
+        return [
+            {namespace: 'dash_html_components', type: 'H3', props: {children: 'Total ' + label + ': ', style: KPI_STYLE}},
+            {namespace: 'dash_html_components', type: 'Div', props: {children: String(Math.trunc(total)), style: KPI_STYLE}},
+        ];
+    }
+
+    function maximum(values) {
+        var result = 0;
+        for (var i = 0; i < values.length; i++) {
+            if (values[i] > result) {
+                result = values[i];
+            }
+        }
+        return result;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        covid: {
+            updateCountry: function (selectedCountry, payload, visibleTraces) {
+                var noUpdate = window.dash_clientside.no_update;
+                if (!selectedCountry || !payload || !(selectedCountry in payload.countries)) {
+                    return [noUpdate, noUpdate, noUpdate, noUpdate, noUpdate];
+                }
+                var series = country(payload, selectedCountry);
+                var visible = visibleTraces || [];
+
+                function trace(name, data, caseType) {
+                    return {
+                        x: data.dates, y: data.values, type: 'line', name: name,
+                        line: {color: 'rgb(' + COLORS[caseType].join(', ') + ')'},
+                        visible: visible.indexOf(name) >= 0 ? true : 'legendonly',
+                    };
+                }
+
+                // Same traces as the server-side chart: each case type, then its forecast band and
+                // its forecast, dashed or dotted for a drift fallback
+                var traces = [];
+                CASE_TYPES.forEach(function (caseType) {
+                    traces.push(trace(caseType, series[caseType], caseType));
+                    var data = series.forecasts[caseType];
+                    if (!data) {
+                        return;
+                    }
+                    var name = caseType + ' Forecast';
+                    var forecast = trace(name, data, caseType);
+                    forecast.legendgroup = name;
+                    forecast.line.dash = data.fallback ? 'dot' : 'dash';
+                    var band = {
+                        x: data.dates, type: 'line', legendgroup: name, showlegend: false,
+                        hoverinfo: 'skip', line: {width: 0}, visible: forecast.visible,
+                    };
+                    traces.push(
+                        Object.assign({}, band, {y: data.lower, name: name + ' lower'}),
+                        Object.assign({}, band, {y: data.upper, name: name + ' upper', fill: 'tonexty',
+                                                 fillcolor: 'rgba(' + COLORS[caseType].join(', ') + ', 0.2)'}),
+                        forecast);
+                });
+
+                var figure = {
+                    data: traces,
+                    layout: {
+                        title: 'COVID-19 Confirmed Cases and Deaths Over Time - ' + selectedCountry,
+                        xaxis: {title: 'Date'},
+                        yaxis: {title: 'Cases'},
+                    },
+                };
+                var kpis = CASE_TYPES.map(function (caseType) {
+                    return kpi(caseType, maximum(series[caseType].values));
+                });
+                return kpis.concat([figure]);
+            },
+        },
+    });
+})();
@@ -0,0 +1,176 @@
+import contextlib
+import datetime
+import json
+import os
+import sys
+import tempfile
+import uuid
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASE_TYPES = "('Confirmed', 10), ('Deaths', 1), ('Active', 5), ('Recovered', 4)"
+STOCKS = ('Close_BioNTech', 'Close_Moderna', 'Close_Johnson & Johnson', 'Close_Inovio Pharmaceuticals',
+          'Close_Sinovac', 'Close_Sinopharm', 'Close_Novavax', 'Close_Astrazeneca')
+
+
+# DuckDB cursor that looks enough like a Snowflake cursor for the app's data layer
+class FakeCursor:
+    def __init__(self, conn):
+        self._cur = conn.cursor()
+        self.sfqid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    def execute(self, query, params=None, timeout=None):
+        if params:
+            query = query.replace('%s', '?')
+        self._cur.execute(query, list(params) if params else [])
+        self.sfqid = str(uuid.uuid4())
+        return self
+
+    def execute_async(self, query, params=None):
+        return self.execute(query, params)
+
+    def get_results_from_sfqid(self, query_id):
+        pass
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchmany(self, size):
+        return self._cur.fetchmany(size)
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def fetch_pandas_batches(self):
+        while True:
+            chunk = self._cur.fetch_df_chunk()
+            if not len(chunk):
+                return
+            yield chunk
+
+    def fetch_arrow_batches(self):
+        yield from self._cur.fetch_record_batch()
+
+    def fetch_arrow_all(self):
+        table = self._cur.fetch_arrow_table()
+        return table if table.num_rows else None
+
+    def close(self):
+        self._cur.close()
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self._conn = database.cursor()
+        self._closed = False
+
+    def cursor(self):
+        return FakeCursor(self._conn)
+
+    def get_query_status_throw_if_error(self, query_id):
+        return 'SUCCESS'
+
+    def is_still_running(self, status):
+        return False
+
+    def is_closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+        self._conn.close()
+
+
+# In-memory warehouse with a synthetic JHU_COVID_19 of countries x provinces x days x 4 case types
+def build_warehouse(countries=50, provinces=4, days=365):
+    import duckdb
+
+    database = duckdb.connect()
+    database.execute(f"""
+        CREATE TABLE JHU_COVID_19 AS
+        SELECT
+            'Country_' || c AS COUNTRY_REGION,
+            'Province_' || c || '_' || p AS PROVINCE_STATE,
+            ct.CASE_TYPE,
+            DATE '2020-01-22' + CAST(d AS INTEGER) AS DATE,
+            CAST((d + 1) * (c + 1) * ct.factor * (p + 1) + (d * 7919 + c * 104729) % 997 AS BIGINT) AS CASES
+        FROM range({countries}) t1(c), range({provinces}) t2(p), range({days}) t3(d),
+            (VALUES {CASE_TYPES}) ct(CASE_TYPE, factor)
+    """)
+    return database
+
+
+# mongomock client with synthetic vaccine maker prices, shared by every MongoClient() call
+def build_mongo(days=365):
+    import mongomock
+
+    client = mongomock.MongoClient()
+    start = datetime.datetime(2020, 1, 22)
+    documents = []
+    for d in range(days):
+        document = {'Date': start + datetime.timedelta(days=d)}
+        for i, stock in enumerate(STOCKS):
+            document[stock] = 20.0 + i * 10 + (d % 30) * 0.5 + d * 0.01
+        documents.append(document)
+    client['Covid']['Stocks'].insert_many(documents)
+    return client
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def lock(self, key):
+        return contextlib.nullcontext()
+
+
+# Point the app at the stand-ins: temp config.json, DuckDB pool, mongomock client, no shared cache
+def install(countries=50, provinces=4, days=365, pool_size=4):
+    import duckdb
+    import pymongo
+
+    workdir = tempfile.mkdtemp(prefix='covid-bench-')
+    config = {
+        'SF_USER': 'bench', 'SF_PASSWORD': 'bench', 'SF_ACCOUNT': 'bench', 'SF_WAREHOUSE': 'bench',
+        'SF_DATABASE': 'bench', 'SF_SCHEMA': 'bench',
+        'MONGO_USERNAME': 'bench', 'MONGO_PASSWORD': 'bench', 'MONGO_CLUSTER': 'localhost',
+        'FORECAST_PRECOMPUTE': False,
+        'CLUSTER_WORKERS': 1,
+        'CACHE_DIR': os.path.join(workdir, 'cache'),
+    }
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    os.chdir(workdir)
+    os.environ['COVID_CONFIG'] = os.path.join(workdir, 'config.json')
+    if PROJECT_DIR not in sys.path:
+        sys.path.insert(0, PROJECT_DIR)
+
+    mongo = build_mongo(days)
+    pymongo.MongoClient = lambda *args, **kwargs: mongo
+
+    database = build_warehouse(countries, provinces, days)
+    import shared_cache
+    import snowflake_pool
+
+    snowflake_pool.set_pool(snowflake_pool.SnowflakePool(
+        lambda: FakeConnection(database), size=pool_size, user_errors=(duckdb.Error,)))
+    snowflake_pool.set_sql_pool(snowflake_pool.SnowflakePool(
+        lambda: FakeConnection(database), size=pool_size, user_errors=(duckdb.Error,)))
+    shared_cache._cache = NullCache()
+    return workdir
@@ -0,0 +1,257 @@
+# Benchmark the dashboard callbacks and page data loads against local stand-ins for Snowflake and MongoDB.
+#
+#   python benchmarks/run_benchmarks.py                    # compare against benchmarks/baseline.json
+#   python benchmarks/run_benchmarks.py --update-baseline  # record a new baseline
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+import fakes  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Dashboard performance benchmarks')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--cold-starts', type=int, default=3)
+    parser.add_argument('--countries', type=int, default=50)
+    parser.add_argument('--provinces', type=int, default=4)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown of p50 and growth of peak memory')
+    parser.add_argument('--cold-start-child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def dataset(args):
+    return {'countries': args.countries, 'provinces': args.provinces, 'days': args.days}
+
+
+# Time one import of the app in a fresh interpreter. The result goes to its own file, the app
+# prints to stdout, and the child waits for the warm-up thread so it does not run into shutdown.
+def cold_start_child(args):
+    import resource
+    import threading
+
+    fakes.install(args.countries, args.provinces, args.days)
+    started = time.perf_counter()
+    import Covid_project
+    seconds = time.perf_counter() - started
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(args.result_file, 'w') as f:
+        json.dump({'seconds': seconds, 'peak_kb': peak_kb}, f)
+
+    for thread in threading.enumerate():
+        if thread.name == 'page-warm-up':
+            thread.join(600)
+    Covid_project.comment_writer.close()
+
+
+def measure_cold_start(args):
+    import tempfile
+
+    samples, peaks = [], []
+    for _ in range(args.cold_starts):
+        fd, result_file = tempfile.mkstemp(prefix='covid-cold-start-', suffix='.json')
+        os.close(fd)
+        command = [sys.executable, os.path.abspath(__file__), '--cold-start-child', '--result-file', result_file,
+                   '--countries', str(args.countries), '--provinces', str(args.provinces), '--days', str(args.days)]
+        try:
+            subprocess.run(command, check=True, capture_output=True, text=True)
+            with open(result_file) as f:
+                result = json.load(f)
+        finally:
+            os.remove(result_file)
+        samples.append(result['seconds'])
+        peaks.append(result['peak_kb'])
+    return summarize(samples, max(peaks))
+
+
+def summarize(samples, peak_kb):
+    return {
+        'p50': float(np.percentile(samples, 50)),
+        'p99': float(np.percentile(samples, 99)),
+        'peak_kb': int(peak_kb),
+        'runs': len(samples),
+    }
+
+
+# Run fn `iterations` times, calling setup before each run outside the timed section,
+# then once more under tracemalloc for the peak allocation
+def measure(fn, iterations, setup=None):
+    samples = []
+    for i in range(iterations):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - started)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        fn(iterations)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return summarize(samples, peak / 1024)
+
+
+def wait_for_warm_up(timeout=600):
+    import lazy_data
+
+    deadline = time.monotonic() + timeout
+    while not all(dataset.ready for dataset in lazy_data._registry):
+        if time.monotonic() > deadline:
+            raise RuntimeError('page warm-up did not finish')
+        time.sleep(0.1)
+
+
+def run_triggered(fn, prop_id, *args):
+    from contextvars import copy_context
+    from dash._callback_context import context_value
+    from dash._utils import AttributeDict
+
+    def run():
+        context_value.set(AttributeDict(triggered_inputs=[{'prop_id': prop_id, 'value': 1}]))
+        return fn(*args)
+
+    return copy_context().run(run)
+
+
+def run_benchmarks(args):
+    results = {'app.cold_start': measure_cold_start(args)}
+
+    fakes.install(args.countries, args.provinces, args.days)
+    import Covid_project
+    import covid_data
+    import forecasting
+    from country_index import country_index
+    from query_results import get_result_store
+    from pages import main, sql_querry, Comparison, Regions
+
+    wait_for_warm_up()
+
+    countries = [f'Country_{i}' for i in range(args.countries)]
+
+    def country(i):
+        return countries[i % len(countries)]
+
+    def drop_series():
+        covid_data._country_cache.clear()
+
+    def drop_forecasts():
+        drop_series()
+        forecasting._forecasts.clear()
+        # the engine's fit pool is kept, only the fitted states are dropped
+        forecasting.engine._states.clear()
+        forecasting.engine._warm_params.clear()
+
+    store = get_result_store()
+    sql = 'SELECT * FROM JHU_COVID_19 WHERE CASE_TYPE = \'Confirmed\''
+
+    def run_sql(i):
+        run_triggered(sql_querry.execute_sql_query_or_remove_table, 'execute-button.n_clicks',
+                      1, None, sql, f'bench-{i}')
+
+    cases = [
+        ('main.update_kpis', lambda i: main.update_kpis.__wrapped__(country(i)), drop_series),
+        ('main.update_data (cold)', lambda i: main.update_data.__wrapped__(country(i)), drop_forecasts),
+        ('main.update_data (warm)', lambda i: main.update_data.__wrapped__(country(0)), None),
+        ('main.update_dropdown_options', lambda i: main.update_dropdown_options(None), None),
+        ('main.country_index_load', lambda i: country_index.countries(), country_index.invalidate),
+        ('sql.execute (miss)', run_sql, store.cache.clear),
+        ('sql.execute (hit)', run_sql, None),
+        ('sql.update_table_page', lambda i: sql_querry.update_table_page(
+            1, i % 10, 50, [{'column_id': 'CASES', 'direction': 'desc'}], '{CASES} gt 100', f'bench-{args.iterations}'),
+         None),
+        ('app.handle_comment_submit', lambda i: Covid_project.handle_comment_submit(1, f'benchmark comment {i}'), None),
+        ('comparison.build_data', lambda i: Comparison.build_comparison_data(), None),
+        ('regions.build_clusters', lambda i: Regions.load_cluster_results.__wrapped__(), None),
+    ]
+
+    for name, fn, setup in cases:
+        iterations = max(3, args.iterations // 5) if name.startswith('regions.') else args.iterations
+        results[name] = measure(fn, iterations, setup)
+        print(f'  measured {name}', file=sys.stderr)
+
+    Covid_project.comment_writer.close()
+    return results
+
+
+def print_results(results, baseline=None):
+    print(f'{"benchmark":<34} {"p50 ms":>10} {"p99 ms":>10} {"peak KiB":>10} {"vs base p50":>12}')
+    for name, result in results.items():
+        change = ''
+        if baseline and name in baseline:
+            change = f'{result["p50"] / baseline[name]["p50"] - 1:+.0%}'
+        print(f'{name:<34} {result["p50"] * 1000:10.1f} {result["p99"] * 1000:10.1f} '
+              f'{result["peak_kb"]:10d} {change:>12}')
+
+
+# Benchmarks whose p50 or peak memory grew beyond the tolerance
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['p50'] > base['p50'] * (1 + tolerance):
+            found.append(f'{name}: p50 {base["p50"] * 1000:.1f}ms -> {result["p50"] * 1000:.1f}ms')
+        if result['peak_kb'] > base['peak_kb'] * (1 + tolerance):
+            found.append(f'{name}: peak {base["peak_kb"]}KiB -> {result["peak_kb"]}KiB')
+    return found
+
+
+def main():
+    args = parse_args()
+    if args.cold_start_child:
+        cold_start_child(args)
+        return 0
+
+    results = run_benchmarks(args)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'dataset': dataset(args), 'results': results}, f, indent=2)
+        print_results(results)
+        print(f'Baseline written to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print_results(results)
+        print(f'No baseline at {args.baseline}, run with --update-baseline to record one')
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['dataset'] != dataset(args):
+        print(f'Baseline was recorded on {baseline["dataset"]}, not {dataset(args)}')
+        return 2
+
+    print_results(results, baseline['results'])
+    found = regressions(results, baseline['results'], args.tolerance)
+    if found:
+        print('Regressions:')
+        for line in found:
+            print(f'  {line}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
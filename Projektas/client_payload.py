@@ -0,0 +1,63 @@
+import base64
+
+import numpy as np
+
+from concurrent_queries import gather
+from covid_data import get_all_country_series, get_data_version
+from forecasting import CASE_TYPES, get_cached_forecast
+
+FORECAST_STEPS = 30
+_NUMPY_TYPES = {'int32': '<i4', 'float64': '<f8'}
+_INT32_MAX = np.iinfo(np.int32).max
+
+
+# Little-endian typed array as base64, decoded in the browser with the matching TypedArray
+def _typed(array, dtype):
+    data = np.asarray(array).astype(_NUMPY_TYPES[dtype]).tobytes()
+    return {'dtype': dtype, 'data': base64.b64encode(data).decode('ascii')}
+
+
+# Days since 1970-01-01, first value absolute and the rest as differences to the previous day
+def _encode_dates(dates):
+    days = np.asarray(dates, dtype='datetime64[D]').astype('int64')
+    return _typed(np.diff(days, prepend=0), 'int32')
+
+
+# Cumulative counts are stored as day-to-day differences (small numbers that compress well),
+# anything that does not fit in int32 stays float64
+def _encode_values(values):
+    array = np.asarray(values, dtype='float64')
+    deltas = np.diff(array, prepend=0.0)
+    if np.all(deltas == np.round(deltas)) and np.all(np.abs(deltas) <= _INT32_MAX):
+        return dict(_typed(deltas, 'int32'), delta=True)
+    return dict(_typed(array, 'float64'), delta=False)
+
+
+def encode_country(country, series):
+    encoded = {}
+    for case_type, (dates, values) in series.items():
+        encoded[case_type] = {'dates': _encode_dates(dates), 'values': _encode_values(values)}
+
+    # only forecasts the precompute job (or an earlier chart request) already cached are sent
+    encoded['forecasts'] = {}
+    for case_type in CASE_TYPES:
+        dates, values = series[case_type]
+        forecast = get_cached_forecast(country, case_type, dates, values, forecast_steps=FORECAST_STEPS)
+        if forecast is not None:
+            values, lower, upper, kind = forecast
+            encoded['forecasts'][case_type] = {
+                'values': _typed(values, 'float64'), 'lower': _typed(lower, 'float64'),
+                'upper': _typed(upper, 'float64'), 'fallback': kind == 'fallback',
+            }
+    return encoded
+
+
+# Every country's daily series and cached forecasts for the browser-side country switching
+def build_country_payload():
+    gathered = gather({'version': (get_data_version,), 'series': (get_all_country_series,)})
+    version = gathered.get('version')
+    return {
+        'version': f'{version[0]}-{version[1]}',
+        'countries': {country: encode_country(country, series)
+                      for country, series in gathered.get('series').items()},
+    }
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+from covid_data import fetch_daily_rows
+from worker_processes import process_pool
+
+# Confirmed cases and deaths per region in one scan
+REGIONS_QUERY = """
+SELECT
+    PROVINCE_STATE,
+    MAX(CASE WHEN CASE_TYPE = 'Confirmed' THEN CASES ELSE 0 END) AS CONFIRMED,
+    MAX(CASE WHEN CASE_TYPE = 'Deaths' THEN CASES ELSE 0 END) AS DEATHS
+FROM
+    {table}
+WHERE
+    CASE_TYPE IN ('Confirmed', 'Deaths')
+GROUP BY
+    PROVINCE_STATE
+"""
+
+# Feature choices offered on the Regions page: label and a function building the feature matrix
+FEATURE_SETS = {
+    'cases_deaths': ('Confirmed and deaths',
+                     lambda data: data[['CONFIRMED', 'DEATHS']].to_numpy(dtype='float64')),
+    'log_cases_deaths': ('Confirmed and deaths (log scale)',
+                         lambda data: np.log1p(data[['CONFIRMED', 'DEATHS']].to_numpy(dtype='float64'))),
+    'cases_death_rate': ('Confirmed and death rate',
+                         lambda data: np.column_stack([
+                             np.log1p(data['CONFIRMED'].to_numpy(dtype='float64')),
+                             data['DEATH_RATE'].to_numpy(dtype='float64'),
+                         ])),
+}
+
+K_VALUES = range(2, 11)
+
+
+# One clustering fit, kept at module level so it can run in a worker process
+def fit_clusters(features, k, minibatch_threshold=5000, silhouette_sample=5000):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    from sklearn.metrics import silhouette_score
+    from sklearn.preprocessing import StandardScaler
+
+    scaled_data = StandardScaler().fit_transform(features)
+    if len(scaled_data) > minibatch_threshold:
+        model = MiniBatchKMeans(n_clusters=k, random_state=42, batch_size=4096, n_init=3)
+    else:
+        model = KMeans(n_clusters=k, random_state=42, n_init=10)
+    labels = model.fit_predict(scaled_data)
+
+    sample_size = silhouette_sample if len(scaled_data) > silhouette_sample else None
+    score = float(silhouette_score(scaled_data, labels, sample_size=sample_size, random_state=42))
+    return labels.astype(np.int32), score
+
+
+def load_region_totals():
+    columns, rows = fetch_daily_rows(REGIONS_QUERY)
+    data = pd.DataFrame(rows, columns=columns)
+    data['CONFIRMED'] = data['CONFIRMED'].astype('float64')
+    data['DEATHS'] = data['DEATHS'].astype('float64')
+    confirmed = data['CONFIRMED'].to_numpy()
+    data['DEATH_RATE'] = np.divide(data['DEATHS'].to_numpy(), confirmed, out=np.zeros(len(data)), where=confirmed > 0)
+    return data
+
+
+# Region totals with labels and silhouette scores for every (feature set, k) pair
+class ClusterResults:
+    def __init__(self, data, results):
+        self.data = data
+        self._results = results
+
+    def get(self, feature_key, k):
+        return self._results.get((feature_key, k))
+
+    def silhouettes(self, feature_key):
+        return {k: score for (key, k), (_, score) in self._results.items() if key == feature_key}
+
+
+# Fit every (feature set, k) combination in a process pool
+def build_cluster_results(k_values=K_VALUES, workers=None, minibatch_threshold=5000):
+    data = load_region_totals()
+    jobs = {}
+    with process_pool(workers) as pool:
+        for feature_key, (_, build_features) in FEATURE_SETS.items():
+            features = build_features(data)
+            for k in k_values:
+                if k < len(features):
+                    jobs[(feature_key, k)] = pool.submit(fit_clusters, features, k, minibatch_threshold)
+
+        results = {}
+        for key, future in jobs.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                print(f'Clustering {key} failed: {e}')
+    return ClusterResults(data, results)
@@ -0,0 +1,131 @@
+import atexit
+import queue
+import threading
+import time
+
+
+# Background comment writer: callbacks enqueue, a worker thread inserts in batches with insert_many
+class CommentWriter:
+    def __init__(self, collection, batch_size=100, flush_interval=1.0, max_queue=10000, put_timeout=0.5,
+                 max_retries=3, retry_delay=0.5):
+        self.collection = collection
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {
+            'submitted': 0,
+            'written': 0,
+            'failed': 0,
+            'retries': 0,
+            'rejected': 0,
+            'batches': 0,
+            'write_seconds': 0.0,
+            'last_write_seconds': None,
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='comment-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    # Blocks for at most put_timeout when the queue is full, then raises queue.Full
+    def submit(self, comment):
+        try:
+            self._queue.put(comment, timeout=self.put_timeout)
+        except queue.Full:
+            self._count('rejected')
+            raise
+        self._count('submitted')
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    # A failed insert is retried (only the comments that were not written) with a growing delay,
+    # up to max_retries times before the rest of the batch is dropped
+    def _write(self, batch):
+        started = time.monotonic()
+        pending = batch
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._count('retries')
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                self.collection.insert_many(pending, ordered=False)
+                pending = []
+            except Exception as e:
+                pending = _unwritten(pending, e)
+                print(f'Writing {len(pending)} comments failed (attempt {attempt + 1}): {e}')
+            if not pending:
+                break
+        self._count('written', len(batch) - len(pending))
+        if pending:
+            self._count('failed', len(pending))
+            print(f'Dropped {len(pending)} comments after {self.max_retries} retries')
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['write_seconds'] += elapsed
+            self.stats['last_write_seconds'] = elapsed
+
+    def _run(self):
+        ensure_comment_index(self.collection)
+        batch = []
+        deadline = None
+        while not (self._stop.is_set() and self._queue.empty()):
+            timeout = self.flush_interval if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            except queue.Empty:
+                pass
+
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline or self._stop.is_set()):
+                self._write(batch)
+                batch = []
+                deadline = None
+        if batch:
+            self._write(batch)
+
+    # Flush everything still queued, called on interpreter shutdown
+    def close(self, timeout=10.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+# Comments of a failed insert_many that still need writing. insert_many sets _id on every document,
+# so a retried comment that did get in fails with a duplicate key (11000) and counts as written.
+def _unwritten(batch, error):
+    details = getattr(error, 'details', None)
+    if not isinstance(details, dict) or 'writeErrors' not in details:
+        return batch
+    failed = {write_error['index'] for write_error in details['writeErrors'] if write_error.get('code') != 11000}
+    return [comment for i, comment in enumerate(batch) if i in failed]
+
+
+# One page of comments, newest first; pass the last created_at seen as `before` for the next page
+def list_comments(collection, limit=20, before=None):
+    query = {'created_at': {'$lt': before}} if before is not None else {}
+    cursor = collection.find(query, {'_id': 0}).sort('created_at', -1).limit(limit)
+    return list(cursor)
+
+
+def ensure_comment_index(collection):
+    try:
+        collection.create_index([('created_at', -1)])
+    except Exception as e:
+        print(f'Could not create created_at index on {collection.name}: {e}')
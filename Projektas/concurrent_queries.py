@@ -0,0 +1,64 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from settings import load_config
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# Outcome of gather(): results of the calls that finished, errors of the ones that did not
+class GatherResult:
+    def __init__(self):
+        self.results = {}
+        self.errors = {}
+
+    def ok(self, name):
+        return name in self.results
+
+    # Result of one call, re-raising its error when it failed
+    def get(self, name):
+        if name in self.errors:
+            raise self.errors[name]
+        return self.results[name]
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# Bounded pool shared by every request; sized like the Snowflake pool so queries do not queue on it twice
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                config = load_config()
+                workers = config.get('QUERY_CONCURRENCY', config.get('SF_POOL_SIZE', 4))
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='query')
+    return _executor
+
+
+# Run independent calls ({name: (fn, *args)}) at the same time and wait at most `timeout` seconds.
+# A failed or late call only lands in errors, the others still return their results.
+# Calls must not gather themselves, the pool is bounded.
+def gather(calls, timeout=None):
+    if timeout is None:
+        timeout = load_config().get('QUERY_DEADLINE', 30.0)
+    executor = get_executor()
+    # each call runs in a copy of the caller's context so metrics keep the callback tags
+    futures = {name: executor.submit(contextvars.copy_context().run, *call) for name, call in calls.items()}
+    wait(futures.values(), timeout=timeout)
+
+    gathered = GatherResult()
+    for name, future in futures.items():
+        if not future.done():
+            future.cancel()
+            gathered.errors[name] = DeadlineExceeded(f'{name} did not finish within {timeout}s')
+        elif future.exception() is not None:
+            gathered.errors[name] = future.exception()
+        else:
+            gathered.results[name] = future.result()
+    return gathered
@@ -0,0 +1,56 @@
+import threading
+import time
+
+from covid_data import fetch_daily_rows
+from settings import load_config
+
+COUNTRIES_QUERY = 'SELECT DISTINCT COUNTRY_REGION FROM {table}'
+
+
+# Sorted list of countries kept in memory, reloaded after ttl seconds or on invalidate()
+class CountryIndex:
+    def __init__(self, loader, ttl=3600.0):
+        self._loader = loader
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._countries = None
+        self._options = None
+        self._loaded_at = None
+
+    def _expired(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def _reload(self):
+        with self._lock:
+            if self._expired():
+                countries = sorted(country for country in self._loader() if country)
+                self._options = [{'label': country, 'value': country} for country in countries]
+                self._countries = countries
+                self._loaded_at = time.monotonic()
+
+    def countries(self):
+        if self._expired():
+            self._reload()
+        return self._countries
+
+    # Ready-made dropdown options
+    def options(self):
+        if self._expired():
+            self._reload()
+        return self._options
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    # Load in a background thread so startup does not wait for the warehouse
+    def preload(self):
+        threading.Thread(target=self.countries, name='country-index', daemon=True).start()
+
+
+def _load_countries():
+    _, rows = fetch_daily_rows(COUNTRIES_QUERY)
+    return [row[0] for row in rows]
+
+
+country_index = CountryIndex(_load_countries, ttl=load_config().get('COUNTRY_INDEX_TTL', 3600.0))
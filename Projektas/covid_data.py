@@ -0,0 +1,162 @@
+import numpy as np
+
+from cache_utils import SingleFlight, TTLCache
+from rollup import daily_table
+from snapshot import DATA_VERSION_QUERY, SOURCE_TABLE, get_snapshot
+from snowflake_pool import get_pool
+
+CASE_TYPES = ('Confirmed', 'Deaths', 'Active', 'Recovered')
+
+# Every case type's daily series for one country, pivoted in a single scan
+COUNTRY_SERIES_QUERY = """
+SELECT DATE,
+    MAX(CASE WHEN CASE_TYPE = 'Confirmed' THEN CASES END) AS CONFIRMED,
+    MAX(CASE WHEN CASE_TYPE = 'Deaths' THEN CASES END) AS DEATHS,
+    MAX(CASE WHEN CASE_TYPE = 'Active' THEN CASES END) AS ACTIVE,
+    MAX(CASE WHEN CASE_TYPE = 'Recovered' THEN CASES END) AS RECOVERED
+FROM {table}
+WHERE COUNTRY_REGION = %s
+    AND CASE_TYPE IN ('Confirmed', 'Deaths', 'Active', 'Recovered')
+GROUP BY DATE
+ORDER BY DATE
+"""
+
+# Same pivot for every country at once, used by background jobs
+ALL_COUNTRIES_SERIES_QUERY = """
+SELECT COUNTRY_REGION, DATE,
+    MAX(CASE WHEN CASE_TYPE = 'Confirmed' THEN CASES END) AS CONFIRMED,
+    MAX(CASE WHEN CASE_TYPE = 'Deaths' THEN CASES END) AS DEATHS,
+    MAX(CASE WHEN CASE_TYPE = 'Active' THEN CASES END) AS ACTIVE,
+    MAX(CASE WHEN CASE_TYPE = 'Recovered' THEN CASES END) AS RECOVERED
+FROM {table}
+WHERE CASE_TYPE IN ('Confirmed', 'Deaths', 'Active', 'Recovered')
+GROUP BY COUNTRY_REGION, DATE
+ORDER BY COUNTRY_REGION, DATE
+"""
+
+_in_flight = SingleFlight()
+_country_cache = TTLCache(maxsize=64, ttl=60.0)
+
+
+# Run a dashboard query and return column names and rows, from the local snapshot when one is
+# configured (ad-hoc SQL goes through query_results and only uses the snapshot offline)
+def fetch_rows(query, params=None):
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot.query(query, params)
+
+    with get_pool().cursor() as cursor:
+        cursor.execute(query, params)
+        columns = [desc[0] for desc in cursor.description]
+        rows = cursor.fetchall()
+    return columns, rows
+
+
+# Run a query and return {column name: numpy array}, fetched column-wise as Arrow when the
+# connector (or the snapshot) supports it
+def fetch_columns(query, params=None):
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return _arrow_columns(snapshot.query_arrow(query, params))
+
+    with get_pool().cursor() as cursor:
+        cursor.execute(query, params)
+        names = [desc[0] for desc in cursor.description]
+        fetch_arrow_all = getattr(cursor, 'fetch_arrow_all', None)
+        if fetch_arrow_all is not None:
+            # None when the query returned no rows
+            table = fetch_arrow_all()
+            if table is None:
+                return {name: np.array([], dtype=object) for name in names}
+            return _arrow_columns(table)
+        rows = cursor.fetchall()
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    return {name: np.array(column, dtype=object) for name, column in zip(names, columns)}
+
+
+def _arrow_columns(table):
+    return {name: table.column(name).to_numpy() for name in table.column_names}
+
+
+# Run a daily MAX(CASES) query written against {table}: the rollup when it is enabled and built,
+# the raw table otherwise (the snapshot only mirrors the raw table)
+def _daily_query(query):
+    table = SOURCE_TABLE if get_snapshot() is not None else daily_table()
+    return query.format(table=table)
+
+
+def fetch_daily_rows(query, params=None):
+    return fetch_rows(_daily_query(query), params)
+
+
+def fetch_daily_columns(query, params=None):
+    return fetch_columns(_daily_query(query), params)
+
+
+# One (country, case type) series: day dates and cumulative counts as numpy arrays.
+# Unpacks like the (dates, values) pair it replaced.
+class Series:
+    __slots__ = ('dates', 'values')
+
+    def __init__(self, dates, values):
+        self.dates = dates
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter((self.dates, self.values))
+
+
+# Integer columns without NULLs are used as they are; anything else drops the NULL days
+def _series(dates, column):
+    if column.dtype.kind in 'iu':
+        return Series(dates, column.astype('int64', copy=False))
+    values = np.asarray(column, dtype='float64')
+    valid = ~np.isnan(values)
+    if valid.all():
+        return Series(dates, values.astype('int64'))
+    return Series(dates[valid], values[valid].astype('int64'))
+
+
+# Splitting pivoted columns (rows start:end) into one Series per case type; slices are views
+def _split_series(columns, start=0, end=None):
+    dates = np.asarray(columns['DATE'][start:end], dtype='datetime64[D]')
+    return {case_type: _series(dates, columns[case_type.upper()][start:end]) for case_type in CASE_TYPES}
+
+
+def _load_country_series(country):
+    return _split_series(fetch_daily_columns(COUNTRY_SERIES_QUERY, (country,)))
+
+
+# Daily series for every case type, shared by the KPI and chart callbacks
+def get_country_series(country):
+    series = _country_cache.get(country)
+    if series is None:
+        series = _in_flight.do(('country-series', country), _load_country_series, country)
+        _country_cache.set(country, series)
+    return series
+
+
+# KPI totals derived in memory from the daily series
+def get_country_kpis(country):
+    series = get_country_series(country)
+    return {case_type: int(item.values.max()) if len(item) else 0 for case_type, item in series.items()}
+
+
+# Daily series for every country, keyed by country name; rows arrive sorted by country so each
+# country is one contiguous slice of the fetched columns
+def get_all_country_series():
+    columns = fetch_daily_columns(ALL_COUNTRIES_SERIES_QUERY)
+    names = columns['COUNTRY_REGION']
+    if not len(names):
+        return {}
+    bounds = np.concatenate(([0], np.flatnonzero(names[1:] != names[:-1]) + 1, [len(names)]))
+    return {names[start]: _split_series(columns, start, end) for start, end in zip(bounds[:-1], bounds[1:])}
+
+
+# Cheap fingerprint of the source table, changes whenever new data is loaded
+def get_data_version():
+    _, rows = fetch_rows(DATA_VERSION_QUERY)
+    return tuple(rows[0])
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+def _as_float(x):
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype('datetime64[ns]').astype('int64').astype('float64')
+    return x.astype('float64')
+
+
+# Largest-Triangle-Three-Buckets: indices of `threshold` points that keep the visual shape
+def lttb(x, y, threshold):
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    xf = _as_float(x)
+    yf = np.asarray(y, dtype='float64')
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        avg_x = xf[next_start:next_end].mean()
+        avg_y = yf[next_start:next_end].mean()
+
+        area = np.abs((xf[a] - avg_x) * (yf[start:end] - yf[a])
+                      - (xf[a] - xf[start:end]) * (avg_y - yf[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+# Min and max of every bucket, keeps spikes that LTTB may smooth over
+def min_max(y, threshold):
+    n = len(y)
+    if threshold >= n or threshold < 4:
+        return np.arange(n)
+
+    yf = np.asarray(y, dtype='float64')
+    buckets = threshold // 2
+    usable = n - n % buckets
+    size = usable // buckets
+    grid = yf[:usable].reshape(buckets, size)
+    offsets = np.arange(buckets) * size
+    picked = np.concatenate([offsets + grid.argmin(axis=1), offsets + grid.argmax(axis=1), [0, n - 1]])
+    return np.unique(picked)
+
+
+def downsample(x, y, threshold, method='lttb'):
+    if method == 'minmax':
+        return min_max(y, threshold)
+    return lttb(x, y, threshold)
@@ -0,0 +1,204 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from query_cache import is_cacheable, normalize_sql
+from query_results import cursor_batches, get_result_store
+from snapshot import get_snapshot, is_offline
+from snowflake_pool import get_sql_pool
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+
+# CSV text chunk by chunk, header first; batches are pandas frames or Arrow tables
+def csv_chunks(batches):
+    header = True
+    for batch in batches:
+        if not isinstance(batch, pd.DataFrame):
+            batch = batch.to_pandas()
+        yield batch.to_csv(index=False, header=header)
+        header = False
+
+
+# Parquet bytes chunk by chunk: one row group per batch, the footer is sent last. Every batch is
+# converted to one schema fixed up front: the given one, else the first batch's widened. Query
+# results come as Arrow tables typed from the result metadata, so a column that is NULL throughout
+# the first batch still has its real type; pandas batches only get the types pandas infers.
+def parquet_chunks(batches, schema=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = io.BytesIO()
+    writer = None
+    for batch in batches:
+        if isinstance(batch, pd.DataFrame):
+            batch = pa.Table.from_pandas(batch, schema=schema, preserve_index=False)
+        elif isinstance(batch, pa.RecordBatch):
+            batch = pa.Table.from_batches([batch])
+        if writer is None:
+            if schema is None:
+                schema = widen_schema(batch.schema)
+            writer = pq.ParquetWriter(sink, schema, compression='zstd')
+        writer.write_table(batch.cast(schema))
+        yield _drain(sink)
+    if writer is not None:
+        writer.close()
+        yield _drain(sink)
+
+
+# Later batches of the same column can come back wider (int8, then int32), nullable, or as float64
+# once they hold a NULL; whole floats and NaN still convert to int64 (NaN as null), fractions do not.
+# A column pandas saw only NULLs in is written as text, which any later values can be cast to.
+def widen_schema(schema):
+    import pyarrow as pa
+
+    fields = []
+    for field in schema:
+        if pa.types.is_integer(field.type):
+            field = field.with_type(pa.int64())
+        elif pa.types.is_floating(field.type):
+            field = field.with_type(pa.float64())
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field.with_nullable(True))
+    return pa.schema(fields)
+
+
+def _drain(sink):
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def encode(batches, fmt, schema=None):
+    return parquet_chunks(batches, schema) if fmt == 'parquet' else csv_chunks(batches)
+
+
+def country_schema():
+    import pyarrow as pa
+
+    # CASES is float64 for the observed counts too, the forecast rows are not whole numbers;
+    # LOWER and UPPER bound the forecast's 95% prediction interval and are empty for observed days
+    return pa.schema([('COUNTRY_REGION', pa.string()), ('CASE_TYPE', pa.string()),
+                      ('DATE', pa.timestamp('s')), ('CASES', pa.float64()),
+                      ('LOWER', pa.float64()), ('UPPER', pa.float64())])
+
+
+# Rows start:start + count of a pandas frame or an Arrow table
+def _rows(table, start, count):
+    if isinstance(table, pd.DataFrame):
+        return table.iloc[start:start + count]
+    return table.slice(start, count)
+
+
+def _slices(table, batch_size):
+    for start in range(0, len(table), batch_size):
+        yield _rows(table, start, batch_size)
+
+
+# Arrow batches of a read-only ad-hoc query, capped at SQL_MAX_ROWS like the SQL page. A cached
+# result is streamed from the result cache, otherwise rows come straight from the cursor one batch
+# at a time. Results Snowflake cannot return as Arrow (SHOW, DESCRIBE) come as pandas frames.
+def sql_batches(sql, batch_size=50000):
+    store = get_result_store()
+    cached = store.cache.get(normalize_sql(sql), arrow=True) if store.cache is not None else None
+    if cached is not None:
+        table, _ = cached
+        yield from _slices(table, batch_size)
+        return
+
+    if is_offline() and get_snapshot() is not None:
+        table = get_snapshot().query_arrow(sql)
+        yield from _slices(_rows(table, 0, store.max_rows), batch_size)
+        return
+
+    with get_sql_pool().cursor(reuse=False) as cursor:
+        cursor.execute(sql, timeout=store.timeout)
+        if cursor.description is None:
+            return
+        remaining = store.max_rows
+        for batch in _arrow_batches(cursor, batch_size):
+            yield _rows(batch, 0, remaining)
+            remaining -= len(batch)
+            if remaining <= 0:
+                return
+
+
+def _arrow_batches(cursor, batch_size):
+    try:
+        return cursor.fetch_arrow_batches()
+    except Exception as e:
+        # raised before anything was fetched, so the rows can still be read the generic way
+        if type(e).__name__ != 'NotSupportedError':
+            raise
+    return cursor_batches(cursor, batch_size)
+
+
+# Country chart series and their forecasts with prediction intervals, the same ones the chart
+# draws, as one long frame
+def country_batches(country):
+    from covid_data import get_country_series
+    from forecasting import CASE_TYPES, forecast_dates, get_forecasts
+
+    series = get_country_series(country)
+    case_series = {case_type: (series[case_type].dates, series[case_type].values) for case_type in CASE_TYPES}
+    for case_type, (dates, values) in case_series.items():
+        yield pd.DataFrame({'COUNTRY_REGION': country, 'CASE_TYPE': case_type, 'DATE': dates,
+                            'CASES': np.asarray(values, dtype='float64'), 'LOWER': np.nan, 'UPPER': np.nan})
+
+    forecasts = get_forecasts(country, case_series, forecast_steps=30)
+    for case_type in CASE_TYPES:
+        forecast = forecasts.get(case_type)
+        if forecast is None:
+            continue
+        yield pd.DataFrame({'COUNTRY_REGION': country, 'CASE_TYPE': f'{case_type} Forecast',
+                            'DATE': forecast_dates(case_series[case_type][0], len(forecast.values)),
+                            'CASES': forecast.values, 'LOWER': forecast.lower, 'UPPER': forecast.upper})
+
+
+# Daily confirmed totals with every stock's close, the data behind combined-chart
+def comparison_batches():
+    from pages.Comparison import comparison_data
+
+    yield comparison_data.get()['frame'].reset_index()
+
+
+def register_export_routes(server):
+    from flask import Response, abort, request, stream_with_context
+
+    def stream(batches, name, schema=None):
+        fmt = request.args.get('format', 'csv')
+        if fmt not in FORMATS:
+            abort(400)
+        mimetype, extension = FORMATS[fmt]
+        return Response(
+            stream_with_context(encode(batches, fmt, schema() if schema and fmt == 'parquet' else None)),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename="{name}.{extension}"'},
+        )
+
+    @server.route('/export/sql')
+    def export_sql():
+        buffer = get_result_store().get(request.args.get('session', ''))
+        if buffer is None or not buffer.sql:
+            abort(404)
+        # a GET (a prefetch, a second click) must never run DML or DDL again
+        if not is_cacheable(buffer.sql):
+            abort(400)
+        return stream(sql_batches(buffer.sql), 'query')
+
+    @server.route('/export/country')
+    def export_country():
+        country = request.args.get('country')
+        if not country:
+            abort(400)
+        return stream(country_batches(country), f'covid_{country}', country_schema)
+
+    @server.route('/export/comparison')
+    def export_comparison():
+        return stream(comparison_batches(), 'cases_and_stocks')
@@ -0,0 +1,464 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import wait
+from concurrent.futures.process import BrokenProcessPool
+from statistics import NormalDist
+
+import numpy as np
+
+from cache_utils import TTLCache
+from metrics import forecast_seconds
+from settings import load_config
+from shared_cache import cache_key, get_shared_cache
+from worker_processes import discard_pool, in_worker_process, process_pool
+
+DEFAULT_ORDER = (1, 1, 0)
+CASE_TYPES = ('Confirmed', 'Deaths', 'Active', 'Recovered')
+# 95% prediction intervals
+ALPHA = 0.05
+
+_forecasts = TTLCache(maxsize=2048, ttl=None)
+
+
+# Forecasts are looked up in this process first, then in the cache shared by all workers.
+# Entries are (values, lower, upper, kind) with kind 'fit' or 'fallback'; fallbacks expire after
+# FORECAST_FALLBACK_TTL in the shared cache and are never copied into the per-process cache.
+def _lookup(key):
+    bands = _forecasts.get(key)
+    if bands is None:
+        bands = get_shared_cache().get(cache_key('forecast-entry', key, {}))
+        if bands is not None and bands[3] != 'fallback':
+            _forecasts.set(key, bands)
+    return bands
+
+
+def _store(key, result):
+    if result.mode == 'fallback':
+        # only kept for a short while, a later request gets another chance at a real fit
+        get_shared_cache().set(cache_key('forecast-entry', key, {}),
+                               (result.values, result.lower, result.upper, 'fallback'),
+                               ttl=load_config().get('FORECAST_FALLBACK_TTL', 600))
+        return
+    bands = (result.values, result.lower, result.upper, 'fit')
+    _forecasts.set(key, bands)
+    get_shared_cache().set(cache_key('forecast-entry', key, {}), bands, ttl=24 * 3600)
+
+
+# Arima forecasting, kept at module level so it can run in a worker process
+def fit_forecast(y, order=DEFAULT_ORDER, start_params=None):
+    from statsmodels.tsa.arima.model import ARIMA
+
+    model = ARIMA(np.asarray(y, dtype='float64'), order=order)
+    fitted_model = model.fit(start_params=start_params)
+    return fitted_model
+
+
+# Results for known parameters, a Kalman filter pass without optimization
+def filter_forecast(y, order, params):
+    from statsmodels.tsa.arima.model import ARIMA
+
+    return ARIMA(np.asarray(y, dtype='float64'), order=order).filter(params)
+
+
+def _bands(results, forecast_steps, alpha=ALPHA):
+    prediction = results.get_forecast(steps=forecast_steps)
+    interval = np.asarray(prediction.conf_int(alpha=alpha))
+    return (np.asarray(prediction.predicted_mean).tolist(), interval[:, 0].tolist(), interval[:, 1].tolist())
+
+
+# One fit with its forecast and prediction interval, run in a worker process
+def fit_forecast_bands(y, order=DEFAULT_ORDER, forecast_steps=60, start_params=None):
+    fitted_model = fit_forecast(y, order, start_params)
+    values, lower, upper = _bands(fitted_model, forecast_steps)
+    converged = bool(fitted_model.mle_retvals.get('converged', True)) if fitted_model.mle_retvals else True
+    return {
+        'values': values,
+        'lower': lower,
+        'upper': upper,
+        'params': np.asarray(fitted_model.params),
+        'converged': converged and bool(np.all(np.isfinite(values))),
+    }
+
+
+# Last value plus the average daily change, with the drift method's prediction interval
+def drift_forecast(y, forecast_steps=60, alpha=ALPHA):
+    y = np.asarray(y, dtype='float64')
+    steps = np.arange(1, forecast_steps + 1)
+    if len(y) < 2:
+        values = np.full(forecast_steps, y[-1] if len(y) else 0.0)
+        return values.tolist(), values.tolist(), values.tolist()
+    diffs = np.diff(y)
+    drift = diffs.mean()
+    sigma = diffs.std(ddof=1) if len(diffs) > 1 else 0.0
+    values = y[-1] + drift * steps
+    spread = NormalDist().inv_cdf(1 - alpha / 2) * sigma * np.sqrt(steps * (1 + steps / (len(y) - 1)))
+    return values.tolist(), (values - spread).tolist(), (values + spread).tolist()
+
+
+def series_hash(x, y):
+    digest = hashlib.blake2b(np.asarray(y, dtype='float64').tobytes(), digest_size=16)
+    digest.update(str(x[-1] if len(x) else '').encode())
+    return digest.hexdigest()
+
+
+def forecast_key(country, case_type, order, forecast_steps, x, y):
+    return country, case_type, tuple(order), forecast_steps, series_hash(x, y)
+
+
+# Days following the last observed date
+def forecast_dates(x, steps):
+    return np.asarray(x, dtype='datetime64[D]')[-1] + np.arange(1, steps + 1)
+
+
+# History followed by the forecast days, as two new arrays (no per-element Python objects)
+def _extend(x, y, forecast_values):
+    x = np.asarray(x, dtype='datetime64[D]')
+    return (np.concatenate([x, forecast_dates(x, len(forecast_values))]),
+            np.concatenate([np.asarray(y, dtype='float64'), forecast_values]))
+
+
+class ForecastResult:
+    __slots__ = ('values', 'lower', 'upper', 'mode', 'fit_seconds')
+
+    def __init__(self, values, mode, fit_seconds=0.0, lower=None, upper=None):
+        self.values = values
+        self.lower = lower if lower is not None else values
+        self.upper = upper if upper is not None else values
+        self.mode = mode    # 'cached', 'update', 'refit' or 'fallback'
+        self.fit_seconds = fit_seconds
+
+
+class _SeriesState:
+    __slots__ = ('results', 'nobs', 'last_date', 'last_value', 'updates', 'fitted_at')
+
+    def __init__(self, results, x, y):
+        self.results = results
+        self.nobs = len(y)
+        self.last_date = x[-1]
+        self.last_value = y[-1]
+        self.updates = 0
+        self.fitted_at = time.monotonic()
+
+
+# Keeps fitted state-space results per series and appends new observations instead of refitting.
+# A full refit only happens on schedule (refit_every updates or refit_after seconds), when the
+# history was revised, or when the new observations drift more than drift_sigma standard errors.
+# Refits run in a process pool, several series at once; a fit that is slower than fit_timeout,
+# fails or does not converge is answered with the drift forecast instead.
+class ForecastEngine:
+    def __init__(self, order=DEFAULT_ORDER, refit_every=7, refit_after=7 * 24 * 3600, drift_sigma=4.0,
+                 fit_timeout=10.0, workers=4):
+        self.order = order
+        self.refit_every = refit_every
+        self.refit_after = refit_after
+        self.drift_sigma = drift_sigma
+        self.fit_timeout = fit_timeout
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._states = {}
+        self._warm_params = {}
+        # series whose fit outlived its timeout and is still running in the pool
+        self._running = {}
+        self._pool = None
+        self.stats = {'updates': 0, 'refits': 0, 'fallbacks': 0, 'timeouts': 0, 'pool_restarts': 0,
+                      'update_seconds': 0.0, 'refit_seconds': 0.0, 'fallback_seconds': 0.0}
+
+    def has_state(self, series_id):
+        return series_id in self._states
+
+    def warm_start(self, series_id, params):
+        self._warm_params[series_id] = params
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = process_pool(self.workers)
+            return self._pool
+
+    # Replaces a broken pool, or one whose every process is held by a timed-out fit; the fits still
+    # running in it are given up and their series fitted again on the next request
+    def _discard_pool(self, pool):
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            self._running.clear()
+            self.stats['pool_restarts'] += 1
+        discard_pool(pool)
+
+    def _needs_refit(self, state, x, y):
+        if state is None or len(y) < state.nobs:
+            return True
+        if state.updates >= self.refit_every or time.monotonic() - state.fitted_at > self.refit_after:
+            return True
+        # history before the new observations must be unchanged
+        if x[state.nobs - 1] != state.last_date or y[state.nobs - 1] != state.last_value:
+            return True
+        new_count = len(y) - state.nobs
+        if new_count:
+            prediction = state.results.get_forecast(steps=new_count)
+            errors = np.abs(np.asarray(y[state.nobs:], dtype='float64') - prediction.predicted_mean)
+            if np.any(errors > self.drift_sigma * np.maximum(prediction.se_mean, 1e-9)):
+                return True
+        return False
+
+    def _record(self, series_id, state, mode, seconds):
+        with self._lock:
+            if state is not None:
+                self._states[series_id] = state
+            self.stats[mode + 's'] += 1
+            self.stats[mode + '_seconds'] += seconds
+        forecast_seconds.observe(seconds, mode)
+
+    def _update(self, series_id, state, x, y, forecast_steps):
+        started = time.monotonic()
+        new_count = len(y) - state.nobs
+        if new_count:
+            results = state.results.append(np.asarray(y[state.nobs:], dtype='float64'), refit=False)
+            updates = state.updates + 1
+            fitted_at = state.fitted_at
+            state = _SeriesState(results, x, y)
+            state.updates = updates
+            state.fitted_at = fitted_at
+        values, lower, upper = _bands(state.results, forecast_steps)
+        seconds = time.monotonic() - started
+        self._record(series_id, state, 'update', seconds)
+        return ForecastResult(values, 'update', seconds, lower, upper)
+
+    def _fallback(self, series_id, y, forecast_steps):
+        started = time.monotonic()
+        values, lower, upper = drift_forecast(y, forecast_steps)
+        seconds = time.monotonic() - started
+        self._record(series_id, None, 'fallback', seconds)
+        return ForecastResult(values, 'fallback', seconds, lower, upper)
+
+    def _finished_late(self, series_id, future):
+        with self._lock:
+            if self._running.get(series_id) is future:
+                del self._running[series_id]
+        if not future.cancelled() and future.exception() is None:
+            # the next refit of this series starts from the late fit's parameters
+            self.warm_start(series_id, future.result()['params'])
+
+    # Forecasts for several series ({series_id: (x, y)}) at once: cheap updates run here,
+    # refits run in parallel in the pool and are waited for at most fit_timeout seconds
+    def forecast_many(self, series, forecast_steps=60):
+        results = {}
+        fits = {}
+        pools = {}
+        started = time.monotonic()
+        for series_id, (x, y) in series.items():
+            with self._lock:
+                state = self._states.get(series_id)
+                running = series_id in self._running
+            if running:
+                results[series_id] = self._fallback(series_id, y, forecast_steps)
+                continue
+            try:
+                if not self._needs_refit(state, x, y):
+                    results[series_id] = self._update(series_id, state, x, y, forecast_steps)
+                    continue
+            except Exception as e:
+                print(f'Forecast update failed for {series_id}: {e}')
+            start_params = state.results.params if state is not None else self._warm_params.get(series_id)
+            pool = self._get_pool()
+            try:
+                fits[series_id] = pool.submit(fit_forecast_bands, y, self.order, forecast_steps, start_params)
+                pools[series_id] = pool
+            except RuntimeError as e:
+                # broken, or discarded by another request meanwhile
+                print(f'Forecast pool unavailable for {series_id}: {e}')
+                self._discard_pool(pool)
+                results[series_id] = self._fallback(series_id, y, forecast_steps)
+
+        wait(fits.values(), timeout=self.fit_timeout)
+        seconds = time.monotonic() - started
+        for series_id, future in fits.items():
+            x, y = series[series_id]
+            if not future.done():
+                with self._lock:
+                    self._running[series_id] = future
+                    self.stats['timeouts'] += 1
+                future.add_done_callback(lambda done, series_id=series_id: self._finished_late(series_id, done))
+                results[series_id] = self._fallback(series_id, y, forecast_steps)
+                continue
+            try:
+                bands = future.result()
+            except BrokenProcessPool as e:
+                print(f'Forecast pool broke while fitting {series_id}: {e}')
+                self._discard_pool(pools[series_id])
+                bands = None
+            except Exception as e:
+                print(f'Forecast fit failed for {series_id}: {e}')
+                bands = None
+            if bands is None or not bands['converged']:
+                results[series_id] = self._fallback(series_id, y, forecast_steps)
+                continue
+            # filtered in this process with the fitted parameters so new days can be appended later
+            state = _SeriesState(filter_forecast(y, self.order, bands['params']), x, y)
+            self._record(series_id, state, 'refit', seconds)
+            results[series_id] = ForecastResult(bands['values'], 'refit', seconds, bands['lower'], bands['upper'])
+
+        with self._lock:
+            stuck = self._pool if len(self._running) >= self.workers else None
+        if stuck is not None:
+            self._discard_pool(stuck)
+        return results
+
+    def forecast(self, series_id, x, y, forecast_steps=60):
+        return self.forecast_many({series_id: (x, y)}, forecast_steps)[series_id]
+
+
+def _engine_from_config():
+    config = load_config()
+    return ForecastEngine(
+        fit_timeout=config.get('FORECAST_FIT_TIMEOUT', 10.0),
+        workers=config.get('FORECAST_FIT_WORKERS', len(CASE_TYPES)),
+    )
+
+
+engine = _engine_from_config()
+
+
+# Cached forecasts for several case types of one country ({case_type: (x, y)}); the misses are
+# fitted together by the engine, so the slowest fit bounds the latency, not their sum
+def get_forecasts(country, series, order=DEFAULT_ORDER, forecast_steps=60):
+    results = {}
+    missing = {}
+    for case_type, (x, y) in series.items():
+        if len(y) < 3:
+            continue
+        key = forecast_key(country, case_type, order, forecast_steps, x, y)
+        bands = _lookup(key)
+        if bands is not None:
+            # a cached drift forecast keeps its mode so the chart still marks it
+            mode = 'fallback' if bands[3] == 'fallback' else 'cached'
+            results[case_type] = ForecastResult(bands[0], mode, lower=bands[1], upper=bands[2])
+        else:
+            missing[case_type] = key
+
+    if tuple(order) == engine.order:
+        fitted = engine.forecast_many({(country, case_type): series[case_type] for case_type in missing},
+                                      forecast_steps)
+        fitted = {series_id[1]: result for series_id, result in fitted.items()}
+    else:
+        fitted = {}
+        for case_type in missing:
+            started = time.monotonic()
+            bands = fit_forecast_bands(series[case_type][1], order, forecast_steps)
+            fitted[case_type] = ForecastResult(bands['values'], 'refit', time.monotonic() - started,
+                                               bands['lower'], bands['upper'])
+            forecast_seconds.observe(fitted[case_type].fit_seconds, 'refit')
+
+    for case_type, result in fitted.items():
+        _store(missing[case_type], result)
+        results[case_type] = result
+    return results
+
+
+# Cached forecast for one series; a miss is served by the incremental engine
+def get_forecast_result(country, case_type, x, y, order=DEFAULT_ORDER, forecast_steps=60):
+    return get_forecasts(country, {case_type: (x, y)}, order, forecast_steps).get(case_type)
+
+
+# (values, lower, upper, kind) already in the local or shared cache, None when nothing was computed yet
+def get_cached_forecast(country, case_type, x, y, order=DEFAULT_ORDER, forecast_steps=60):
+    return _lookup(forecast_key(country, case_type, order, forecast_steps, x, y))
+
+
+def get_forecast(country, case_type, x, y, order=DEFAULT_ORDER, forecast_steps=60):
+    result = get_forecast_result(country, case_type, x, y, order, forecast_steps)
+    return _extend(x, y, result.values)
+
+
+# Background job refitting every country's forecasts in a process pool whenever the data changes
+class ForecastPrecomputer:
+    def __init__(self, case_types=CASE_TYPES, order=DEFAULT_ORDER, forecast_steps=30,
+                 workers=None, interval=600):
+        self.case_types = case_types
+        self.order = order
+        self.forecast_steps = forecast_steps
+        self.workers = workers
+        self.interval = interval
+        self.data_version = None
+        self.last_run_seconds = None
+        self._thread = None
+
+    def run_once(self):
+        from covid_data import get_all_country_series, get_data_version
+
+        version = get_data_version()
+        if version == self.data_version:
+            return 0
+
+        # One worker fits at a time, the others then find its forecasts in the shared cache
+        with get_shared_cache().lock('forecast-precompute'):
+            return self._precompute(version, get_all_country_series())
+
+    def _precompute(self, version, all_series):
+        started = time.monotonic()
+        jobs = {}
+        with process_pool(self.workers) as pool:
+            for country, series in all_series.items():
+                for case_type in self.case_types:
+                    x, y = series[case_type]
+                    if len(y) < 3:
+                        continue
+                    key = forecast_key(country, case_type, self.order, self.forecast_steps, x, y)
+                    # drift fallbacks are fitted again like a miss
+                    cached = _lookup(key)
+                    if cached is not None and cached[3] != 'fallback':
+                        continue
+                    if self.order == engine.order and engine.has_state((country, case_type)):
+                        # series already fitted in this process only need the new days appended
+                        try:
+                            result = engine.forecast((country, case_type), x, y, self.forecast_steps)
+                            _store(key, result)
+                        except Exception as e:
+                            print(f'Forecast update failed for {key[:2]}: {e}')
+                    else:
+                        jobs[key] = pool.submit(fit_forecast_bands, y, self.order, self.forecast_steps)
+
+            for key, future in jobs.items():
+                try:
+                    bands = future.result()
+                    # series that did not converge are left to the on-demand path and its fallback
+                    if bands['converged']:
+                        _store(key, ForecastResult(bands['values'], 'refit', lower=bands['lower'], upper=bands['upper']))
+                    # on-demand fits for this series start from the precomputed parameters
+                    engine.warm_start(key[:2], bands['params'])
+                except Exception as e:
+                    print(f'Forecast precompute failed for {key[:2]}: {e}')
+
+        self.data_version = version
+        self.last_run_seconds = time.monotonic() - started
+        return len(jobs)
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f'Forecast precompute failed: {e}')
+            time.sleep(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='forecast-precompute', daemon=True)
+            self._thread.start()
+        return self
+
+
+_precomputer = None
+
+
+def start_precompute():
+    global _precomputer
+    config = load_config()
+    if _precomputer is None and config.get('FORECAST_PRECOMPUTE', True) and not in_worker_process():
+        _precomputer = ForecastPrecomputer(
+            workers=config.get('FORECAST_WORKERS'),
+            interval=config.get('FORECAST_PRECOMPUTE_INTERVAL', 600),
+        ).start()
+    return _precomputer
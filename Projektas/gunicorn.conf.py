@@ -0,0 +1,11 @@
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8888')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('THREADS', 4))
+worker_class = 'gthread'
+timeout = 120
+# Every worker imports the app itself so its background threads (warm-up, comment writer,
+# forecast precompute) run inside the worker and are not lost when the master forks
+preload_app = False
@@ -0,0 +1,129 @@
+import threading
+import time
+
+from startup_timing import timed
+
+_registry = []
+
+
+# Page dataset built on first use (or by the warm-up task) instead of at import time.
+# With a refresh_interval the refresh scheduler rebuilds it in the background and swaps the new
+# value in, requests keep getting the previous value while the rebuild runs.
+class LazyDataset:
+    def __init__(self, name, builder, refresh_interval=None):
+        self.name = name
+        self.refresh_interval = refresh_interval
+        self._builder = builder
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # (value, built_at) replaced as one tuple so readers never see a half-swapped pair
+        self._state = None
+        self.last_build_seconds = None
+        self.refreshes = 0
+        self.failures = 0
+        _registry.append(self)
+
+    def _build(self):
+        started = time.perf_counter()
+        value = self._builder()
+        self.last_build_seconds = time.perf_counter() - started
+        return value, time.time()
+
+    def get(self):
+        if self._state is None:
+            with self._lock:
+                if self._state is None:
+                    with timed(f'build {self.name}'):
+                        self._state = self._build()
+        return self._state[0]
+
+    # Rebuild and swap; a failed rebuild keeps serving the previous value
+    def refresh(self):
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            self._state = self._build()
+            self.refreshes += 1
+            return True
+        except Exception as e:
+            self.failures += 1
+            print(f'Refresh of {self.name} failed, keeping the previous data: {e}')
+            return False
+        finally:
+            self._refresh_lock.release()
+
+    @property
+    def ready(self):
+        return self._state is not None
+
+    # When the current value was built; changes on every swap, usable as a cache key
+    @property
+    def built_at(self):
+        state = self._state
+        return state[1] if state is not None else None
+
+    # Seconds since the current value was built, None before the first build
+    @property
+    def age(self):
+        state = self._state
+        return time.time() - state[1] if state is not None else None
+
+    def is_due(self):
+        age = self.age
+        return self.refresh_interval is not None and age is not None and age >= self.refresh_interval
+
+    @property
+    def stats(self):
+        return {
+            'ready': int(self.ready),
+            'age_seconds': self.age,
+            'last_build_seconds': self.last_build_seconds,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+        }
+
+
+def datasets():
+    return list(_registry)
+
+
+def _warm(datasets):
+    for dataset in datasets:
+        try:
+            dataset.get()
+        except Exception as e:
+            print(f'Warm-up of {dataset.name} failed: {e}')
+
+
+# Build every registered dataset in a background thread, off the import path
+def warm_up(on_done=None):
+    datasets = list(_registry)
+
+    def run():
+        with timed('warm-up (all datasets)'):
+            _warm(datasets)
+        if on_done is not None:
+            on_done()
+
+    thread = threading.Thread(target=run, name='page-warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+def _refresh_loop(scheduled, tick):
+    while True:
+        time.sleep(tick)
+        for dataset in scheduled:
+            if dataset.is_due():
+                dataset.refresh()
+
+
+# One background thread rebuilding every dataset that has a refresh_interval once it is due
+def start_refresh():
+    scheduled = [dataset for dataset in _registry if dataset.refresh_interval]
+    if not scheduled:
+        return None
+    tick = min(max(min(dataset.refresh_interval for dataset in scheduled) / 4, 1), 60)
+    thread = threading.Thread(target=_refresh_loop, args=(scheduled, tick), name='dataset-refresh', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,501 @@
+import contextvars
+import glob
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from settings import load_config, private_directory
+from worker_processes import in_worker_process
+
+PREFIX = 'covid_'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# (page, callback) of the Dash callback running in this thread; background jobs keep the default
+current_callback = contextvars.ContextVar('current_callback', default=('background', 'background'))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(total, values):
+        for labels, value in values.items():
+            total[labels] = total.get(labels, 0) + value
+
+    def samples(self, values):
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        self.name = PREFIX + name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # labels -> [count per bucket..., +Inf count, sum]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {labels: list(counts) for labels, counts in self._values.items()}
+
+    @staticmethod
+    def merge(total, values):
+        for labels, counts in values.items():
+            if labels in total:
+                total[labels] = [a + b for a, b in zip(total[labels], counts)]
+            else:
+                total[labels] = list(counts)
+
+    def samples(self, values):
+        for labels, counts in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket{_labels(self.labelnames, labels, ("le", bound))} {count}'
+            yield f'{self.name}_bucket{_labels(self.labelnames, labels, ("le", "+Inf"))} {counts[-2]}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {counts[-1]}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {counts[-2]}'
+
+
+_metrics = []
+# name -> function returning a dict of numeric stats, rendered as gauges
+_stats = {}
+
+
+def counter(name, help, labelnames=()):
+    metric = Counter(name, help, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name, help, labelnames=()):
+    metric = Histogram(name, help, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+# Expose an existing stats dict (pool, caches, writers) as gauges named <name>_<key>
+def register_stats(name, collect):
+    _stats[name] = collect
+
+
+TAGS = ('page', 'callback')
+
+callback_seconds = histogram('dash_callback_seconds', 'Dash callback request duration, serialization included', TAGS)
+callback_bytes = counter('dash_callback_response_bytes_total', 'Bytes returned by Dash callbacks', TAGS)
+callback_errors = counter('dash_callback_errors_total', 'Dash callback requests that failed', TAGS)
+
+connect_seconds = histogram('snowflake_connect_seconds', 'Time to open a new Snowflake session')
+query_seconds = histogram('query_seconds', 'Query duration until the last row was fetched', ('backend',) + TAGS)
+query_rows = counter('query_rows_total', 'Rows or documents fetched', ('backend',) + TAGS)
+query_bytes = counter('query_bytes_total', 'Approximate bytes fetched', ('backend',) + TAGS)
+query_errors = counter('query_errors_total', 'Queries that raised an error', ('backend',) + TAGS)
+
+forecast_seconds = histogram('forecast_fit_seconds', 'ARIMA fit or update duration', ('mode',))
+
+_slow_queries = deque(maxlen=100)
+
+
+def slow_query_threshold():
+    return load_config().get('SLOW_QUERY_SECONDS', 1.0)
+
+
+def record_query(backend, query, seconds, rows, nbytes, error=False):
+    tags = (backend,) + current_callback.get()
+    query_seconds.observe(seconds, *tags)
+    query_rows.inc(rows, *tags)
+    query_bytes.inc(nbytes, *tags)
+    if error:
+        query_errors.inc(1, *tags)
+    if seconds >= slow_query_threshold():
+        entry = {
+            'at': datetime.now().isoformat(timespec='seconds'),
+            'backend': backend,
+            'page': tags[1],
+            'callback': tags[2],
+            'seconds': round(seconds, 3),
+            'rows': rows,
+            'error': error,
+            'query': ' '.join(str(query).split())[:2000],
+        }
+        _slow_queries.append(entry)
+        print(f'Slow {backend} query ({seconds:.2f}s, {rows} rows, {tags[1]}/{tags[2]}): {entry["query"][:200]}')
+
+
+# Slow queries of every worker, oldest first
+def slow_queries():
+    entries = [entry for state in _worker_states().values() for entry in state['slow_queries']]
+    return sorted(entries, key=lambda entry: entry['at'])[-_slow_queries.maxlen:]
+
+
+def _rows_bytes(rows):
+    return sum(sys.getsizeof(value) for row in rows for value in row)
+
+
+def _batch_bytes(batch):
+    nbytes = getattr(batch, 'nbytes', None)
+    if nbytes is not None:
+        return nbytes
+    return int(batch.memory_usage(index=False).sum())
+
+
+# Snowflake cursor that times each query from execute to its last fetch and counts what it returned
+class TracedCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._query = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if name in ('fetch_pandas_batches', 'fetch_arrow_batches'):
+            return lambda *args, **kwargs: self._traced_batches(attr(*args, **kwargs))
+        if name in ('fetch_pandas_all', 'fetch_arrow_all'):
+            return lambda *args, **kwargs: self._traced_all(attr, *args, **kwargs)
+        return attr
+
+    def _start(self, query):
+        self._finish()
+        self._query = query
+        self._started = time.perf_counter()
+        self._last = self._started
+        self._rows = 0
+        self._bytes = 0
+        self._error = False
+
+    def _fetched(self, rows, nbytes):
+        self._rows += rows
+        self._bytes += nbytes
+        self._last = time.perf_counter()
+
+    def _finish(self):
+        if self._query is not None:
+            record_query('snowflake', self._query, self._last - self._started, self._rows, self._bytes, self._error)
+            self._query = None
+
+    def _call(self, fn, *args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            if self._query is not None:
+                self._error = True
+                self._last = time.perf_counter()
+            raise
+
+    def execute(self, query, *args, **kwargs):
+        self._start(query)
+        result = self._call(self._cursor.execute, query, *args, **kwargs)
+        self._last = time.perf_counter()
+        return self if result is self._cursor else result
+
+    def execute_async(self, query, *args, **kwargs):
+        self._start(query)
+        return self._call(self._cursor.execute_async, query, *args, **kwargs)
+
+    def get_results_from_sfqid(self, query_id):
+        result = self._call(self._cursor.get_results_from_sfqid, query_id)
+        self._last = time.perf_counter()
+        return result
+
+    def fetchone(self):
+        row = self._call(self._cursor.fetchone)
+        self._fetched(row is not None, _rows_bytes([row]) if row is not None else 0)
+        return row
+
+    def fetchmany(self, size):
+        rows = self._call(self._cursor.fetchmany, size)
+        self._fetched(len(rows), _rows_bytes(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._call(self._cursor.fetchall)
+        self._fetched(len(rows), _rows_bytes(rows))
+        return rows
+
+    def _traced_batches(self, batches):
+        iterator = iter(batches)
+        while True:
+            try:
+                batch = self._call(next, iterator)
+            except StopIteration:
+                self._last = time.perf_counter()
+                return
+            self._fetched(getattr(batch, 'num_rows', None) or len(batch), _batch_bytes(batch))
+            yield batch
+
+    def _traced_all(self, fetch, *args, **kwargs):
+        result = self._call(fetch, *args, **kwargs)
+        if result is None:
+            self._fetched(0, 0)
+        else:
+            self._fetched(getattr(result, 'num_rows', None) or len(result), _batch_bytes(result))
+        return result
+
+    def close(self):
+        self._finish()
+        return self._cursor.close()
+
+
+# Pooled connection whose cursors are traced; status calls go straight to the session
+class TracedConnection:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        return TracedCursor(self._conn.cursor(*args, **kwargs))
+
+
+def _mongo_rows(reply):
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch') or cursor.get('nextBatch') or ())
+    return int(reply.get('n', 0))
+
+
+def register_mongo_listener():
+    # Must run before the MongoClient objects are created
+    import bson
+    from pymongo import monitoring
+
+    class MongoCommandMetrics(monitoring.CommandListener):
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            record_query('mongodb', event.command_name, event.duration_micros / 1e6,
+                         _mongo_rows(event.reply), len(bson.encode(event.reply)))
+
+        def failed(self, event):
+            record_query('mongodb', event.command_name, event.duration_micros / 1e6, 0, 0, error=True)
+
+    monitoring.register(MongoCommandMetrics())
+
+
+# Every worker process writes its metrics, stats and slow queries to its own file in METRICS_DIR;
+# /metrics sums the counters and histograms of all live workers, so any worker answers the scrape
+def metrics_dir():
+    return private_directory(load_config().get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'covid-dashboard-metrics')))
+
+
+def _collect_stats():
+    collected = {}
+    for name, collect in sorted(_stats.items()):
+        try:
+            collected[name] = collect()
+        except Exception as e:
+            print(f'Collecting {name} stats failed: {e}')
+    return collected
+
+
+# Written as JSON, label tuples as lists; non-numeric stats are written as text and not rendered
+def flush():
+    state = {
+        'metrics': {metric.name: [[list(labels), value] for labels, value in metric.snapshot().items()]
+                    for metric in _metrics},
+        'stats': _collect_stats(),
+        'slow_queries': list(_slow_queries),
+    }
+    directory = metrics_dir()
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f, default=str)
+    os.replace(tmp, os.path.join(directory, f'worker-{os.getpid()}.json'))
+
+
+def _load_state(path):
+    with open(path) as f:
+        state = json.load(f)
+    state['metrics'] = {name: {tuple(labels): value for labels, value in values}
+                        for name, values in state['metrics'].items()}
+    return state
+
+
+# A pid we may not signal belongs to another user now, so our worker that had it is gone
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except (ProcessLookupError, PermissionError):
+        return False
+    return True
+
+
+# {pid: state} of every live worker, this one freshly flushed; files of exited workers are removed
+def _worker_states():
+    flush()
+    states = {}
+    for path in glob.glob(os.path.join(metrics_dir(), 'worker-*.json')):
+        pid = os.path.basename(path)[len('worker-'):-len('.json')]
+        if not pid.isdigit():
+            continue
+        try:
+            if not _is_alive(int(pid)):
+                os.remove(path)
+                continue
+            states[int(pid)] = _load_state(path)
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            continue
+    return states
+
+
+def _flush_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush()
+        except Exception as e:
+            print(f'Writing metrics failed: {e}')
+
+
+_flusher = None
+
+
+def start_flush():
+    global _flusher
+    if _flusher is None and not in_worker_process():
+        interval = load_config().get('METRICS_FLUSH_INTERVAL', 5)
+        _flusher = threading.Thread(target=_flush_loop, args=(interval,), name='metrics-flush', daemon=True)
+        _flusher.start()
+
+
+def render():
+    states = _worker_states()
+    lines = []
+    for metric in _metrics:
+        total = {}
+        for state in states.values():
+            metric.merge(total, state['metrics'].get(metric.name, {}))
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples(total))
+
+    # stats are per worker (pool sizes, cache states), labelled with its pid instead of summed
+    gauges = {}
+    for pid, state in sorted(states.items()):
+        for name, stats in state['stats'].items():
+            for key, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges.setdefault(f'{PREFIX}{name}_{key}', []).append((pid, value))
+    for gauge, values in sorted(gauges.items()):
+        lines.append(f'# TYPE {gauge} gauge')
+        lines.extend(f'{gauge}{{pid="{pid}"}} {value}' for pid, value in values)
+    return '\n'.join(lines) + '\n'
+
+
+# Time every Dash callback request (serialization included) and tag queries run inside it
+def instrument_callbacks(app):
+    from flask import g, request
+
+    server = app.server
+    names = {}
+
+    def callback_tags(output):
+        tags = names.get(output)
+        if tags is None:
+            entry = app.callback_map.get(output)
+            fn = entry.get('callback') if entry else None
+            if fn is None:
+                return 'unknown', output
+            module = getattr(fn, '__module__', '') or ''
+            page = module.rsplit('.', 1)[-1] if module.startswith('pages.') else 'app'
+            tags = names[output] = (page, getattr(fn, '__name__', output))
+        return tags
+
+    @server.before_request
+    def start_callback_timer():
+        if request.path.endswith('/_dash-update-component'):
+            body = request.get_json(silent=True) or {}
+            g.metrics_tags = callback_tags(body.get('output', ''))
+            g.metrics_token = current_callback.set(g.metrics_tags)
+            g.metrics_started = time.perf_counter()
+
+    @server.after_request
+    def stop_callback_timer(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            tags = g.metrics_tags
+            callback_seconds.observe(time.perf_counter() - started, *tags)
+            if not response.is_streamed:
+                callback_bytes.inc(response.calculate_content_length() or 0, *tags)
+            if response.status_code >= 500:
+                callback_errors.inc(1, *tags)
+        return response
+
+    @server.teardown_request
+    def reset_callback_tags(exc):
+        # after_request is skipped when the callback raised without an error response
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            callback_seconds.observe(time.perf_counter() - started, *g.metrics_tags)
+            callback_errors.inc(1, *g.metrics_tags)
+        token = g.pop('metrics_token', None)
+        if token is not None:
+            current_callback.reset(token)
+
+
+def register_metrics_routes(server):
+    from flask import Response, jsonify
+
+    start_flush()
+
+    @server.route('/metrics')
+    def metrics():
+        return Response(render(), mimetype='text/plain; version=0.0.4')
+
+    @server.route('/metrics/slow-queries')
+    def metrics_slow_queries():
+        return jsonify(slow_queries())
@@ -1,104 +1,207 @@
 import dash
-from dash import dcc, html
-import snowflake.connector
+from dash import dcc, html, callback, Output, Input
+from functools import lru_cache
 import pandas as pd
 import plotly.graph_objs as go
 import numpy as np
-from pymongo import MongoClient
 import json
+from covid_data import fetch_daily_rows
+from lazy_data import LazyDataset
+from downsample import downsample
+from stock_loader import get_stock_loader
+from concurrent_queries import gather
 
 with open('config.json') as f:
     config = json.load(f)
 
 
-# Connect to mongodb
-conn = MongoClient(f"mongodb+srv://{config['MONGO_USERNAME']}:{config['MONGO_PASSWORD']}@{config['MONGO_CLUSTER']}/?retryWrites=true&w=majority")
-db = conn['Covid']
-collection_stocks = db['Stocks']
-
-data_from_mongo = list(collection_stocks.find({}, {"_id": 1, "Date": 1,
-                                                   "Close_BioNTech": 1, "Close_Moderna": 1, "Close_Johnson & Johnson": 1,
-                                                   "Close_Inovio Pharmaceuticals": 1, "Close_Sinovac": 1, "Close_Sinopharm": 1,
-                                                   "Close_Novavax": 1, "Close_Astrazeneca": 1}))
-
-df_mongo = pd.DataFrame(data_from_mongo)
-
-# Convert _id to string and 'Date' to datetime
-df_mongo['_id'] = df_mongo['_id'].astype(str)
-df_mongo['Date'] = pd.to_datetime(df_mongo['Date'])
-
-# Melting the DataFrame
-df_mongo_long = df_mongo.melt(id_vars=['_id', 'Date'], var_name='Stock', value_name='Close')
-
 # SQL query
 sql_query = """
-SELECT DATE, MAX(CASES) AS TOTAL_CONFIRMED 
-FROM JHU_COVID_19 
+SELECT DATE, MAX(CASES) AS TOTAL_CONFIRMED
+FROM {table}
 WHERE case_type = 'Confirmed'
 GROUP BY DATE;
 """
 
-# Connect to Snowflake
-sf_conn = snowflake.connector.connect(
-    user=config['SF_USER'],
-    password=config['SF_PASSWORD'],
-    account=config['SF_ACCOUNT'],
-    warehouse=config['SF_WAREHOUSE'],
-    database=config['SF_DATABASE'],
-    schema=config['SF_SCHEMA']
-)
-cursor = sf_conn.cursor()
-cursor.execute(sql_query)
-
-# Load data from Snowflake
-df_snowflake = pd.DataFrame(cursor.fetchall(), columns=['Date', 'Total_Confirmed'])
-df_snowflake['Date'] = pd.to_datetime(df_snowflake['Date'])
-
-# Merge the two DataFrames
-merged_df = df_mongo_long.merge(df_snowflake, on="Date", how="inner")
-
-# Separate DataFrames by stock
-df_biontech = merged_df[merged_df['Stock'] == 'Close_BioNTech']
-df_moderna = merged_df[merged_df['Stock'] == 'Close_Moderna']
-df_jj = merged_df[merged_df['Stock'] == 'Close_Johnson & Johnson']
-df_ip = merged_df[merged_df['Stock'] == 'Close_Inovio Pharmaceuticals']
-df_sinovac = merged_df[merged_df['Stock'] == 'Close_Sinovac']
-df_sinopharm = merged_df[merged_df['Stock'] == 'Close_Sinopharm']
-df_novavax = merged_df[merged_df['Stock'] == 'Close_Novavax']
-df_astra = merged_df[merged_df['Stock'] == 'Close_Astrazeneca']
-
-min_stock_date = df_mongo['Date'].min()
-max_stock_date = df_mongo['Date'].max()
-df_snowflake['Date_str'] = df_snowflake['Date'].dt.strftime('%Y-%m-%d')
-min_stock_date_str = min_stock_date.strftime('%Y-%m-%d')
-max_stock_date_str = max_stock_date.strftime('%Y-%m-%d')
+
+# Stock prices from mongodb merged with confirmed cases from snowflake, built on first use
+def build_comparison_data():
+    # Stock prices (only newer documents are fetched on refresh) and the confirmed totals from
+    # Snowflake or the local snapshot are loaded at the same time
+    gathered = gather({
+        'stocks': (get_stock_loader().refresh,),
+        'totals': (fetch_daily_rows, sql_query),
+    })
+
+    _, rows = gathered.get('totals')
+    df_snowflake = pd.DataFrame(rows, columns=['Date', 'Total_Confirmed'])
+    df_snowflake['Date'] = pd.to_datetime(df_snowflake['Date'])
+    totals = df_snowflake.set_index('Date').sort_index()
+
+    if gathered.ok('stocks'):
+        stocks = gathered.results['stocks']
+    else:
+        # the chart still shows the cases when MongoDB is slow or down
+        print(f"Loading stock prices failed: {gathered.errors['stocks']}")
+        stocks = pd.DataFrame(index=pd.DatetimeIndex([], name='Date'))
+
+    # Stock columns next to the daily totals, NaN on days without trading
+    frame = totals.join(stocks, how='left')
+    max_date = stocks.index.max() if len(stocks) else totals.index.max()
+
+    return {
+        'frame': frame,
+        'max_stock_date_str': max_date.strftime('%Y-%m-%d'),
+    }
+
+
+comparison_data = LazyDataset('Comparison stocks and cases', build_comparison_data,
+                              refresh_interval=config.get('COMPARISON_REFRESH_INTERVAL', 600))
 
 external_css = ['https://cdn.jsdelivr.net/npm/bootstrap@5.3.1/dist/css/bootstrap.min.css']
 
 dash.register_page(__name__)
 
 title = 'COVID-19 Clustering Dashboard'
-layout = html.Div([
-    dcc.Graph(
-        id='combined-chart',
-        figure=go.Figure(
-            data=[
-                go.Bar(x=df_snowflake['Date_str'], y=df_snowflake['Total_Confirmed'], name='Total Confirmed Cases'),
-                go.Scatter(x=df_biontech['Date'], y=df_biontech['Close'].astype(np.float16), mode='lines', name='BioNTech', line=dict(color='green'), yaxis='y2'),
-                go.Scatter(x=df_moderna['Date'], y=df_moderna['Close'].astype(np.float16), mode='lines', name='Moderna', line=dict(color='blue'), yaxis='y2'),
-                go.Scatter(x=df_jj['Date'], y=df_jj['Close'].astype(np.float16), mode='lines', name='Johnson & Johnson', line=dict(color='red'), yaxis='y2'),
-                go.Scatter(x=df_ip['Date'], y=df_ip['Close'].astype(np.float16), mode='lines', name='Inovio Pharmaceuticals', line=dict(color='brown'), yaxis='y2'),
-                go.Scatter(x=df_sinovac['Date'], y=df_sinovac['Close'].astype(np.float16), mode='lines', name='Sinovac', line=dict(color='grey'), yaxis='y2'),
-                go.Scatter(x=df_sinopharm['Date'], y=df_sinopharm['Close'].astype(np.float16), mode='lines', name='Sinopharm', line=dict(color='yellow'), yaxis='y2'),
-                go.Scatter(x=df_novavax['Date'], y=df_novavax['Close'].astype(np.float16), mode='lines', name='Novavax', line=dict(color='purple'), yaxis='y2'),
-                go.Scatter(x=df_astra['Date'], y=df_astra['Close'].astype(np.float16), mode='lines', name='Astrazeneca', line=dict(color='black'), yaxis='y2'),
-            ],
-            layout=go.Layout(
-                title='COVID-19 Cases and Stock Prices',
-                xaxis=dict(title='Date', range=['2020-01-22', max_stock_date_str]),  # Set the x-axis range to start from the minimum stock date
-                yaxis=dict(title='Total Confirmed Cases'),
-                yaxis2=dict(title='Stock Value', overlaying='y', side='right'),
-            )
+
+
+# Trace name and colour for every stock column
+stock_traces = [
+    ('Close_BioNTech', 'BioNTech', 'green'),
+    ('Close_Moderna', 'Moderna', 'blue'),
+    ('Close_Johnson & Johnson', 'Johnson & Johnson', 'red'),
+    ('Close_Inovio Pharmaceuticals', 'Inovio Pharmaceuticals', 'brown'),
+    ('Close_Sinovac', 'Sinovac', 'grey'),
+    ('Close_Sinopharm', 'Sinopharm', 'yellow'),
+    ('Close_Novavax', 'Novavax', 'purple'),
+    ('Close_Astrazeneca', 'Astrazeneca', 'black'),
+]
+
+max_points = config.get('COMPARISON_MAX_POINTS', 1000)
+downsample_method = config.get('COMPARISON_DOWNSAMPLE', 'lttb')
+
+# Resampling choices: label and pandas rule (None keeps the daily rows)
+frequencies = {'D': ('Daily', None), 'W': ('Weekly', 'W'), 'M': ('Monthly', 'MS')}
+stock_columns = [column for column, _, _ in stock_traces]
+default_window = 30
+
+
+# Dates and values of one column, reduced to at most max_points
+def column_points(frame, column):
+    dates = frame.index.to_numpy()
+    values = frame[column].to_numpy(dtype='float64')
+    valid = ~np.isnan(values)
+    if not valid.all():
+        dates, values = dates[valid], values[valid]
+    keep = downsample(dates, values, max_points, downsample_method)
+    return dates[keep], values[keep]
+
+
+# Rows between start and end, re-aggregated to the chosen frequency: cumulative cases and
+# closes keep the last value of each period
+def resample_frame(frame, start, end, freq):
+    frame = frame.loc[start:end]
+    rule = frequencies[freq][1]
+    return frame if rule is None else frame.resample(rule).last()
+
+
+# Rolling correlation of every stock's close with the new confirmed cases per period,
+# one vectorized pass over all stock columns
+def rolling_correlations(frame, window):
+    columns = [column for column in stock_columns if column in frame]
+    new_cases = frame['Total_Confirmed'].diff()
+    closes = frame[columns].ffill()
+    return closes.rolling(window, min_periods=max(window // 2, 2)).corr(new_cases)
+
+
+def build_figure(frame, start, end):
+    dates, totals = column_points(frame, 'Total_Confirmed')
+    data = [go.Bar(x=dates, y=totals, name='Total Confirmed Cases')]
+    for column, name, color in stock_traces:
+        if column in frame:
+            dates, closes = column_points(frame, column)
+            data.append(go.Scatter(x=dates, y=closes, mode='lines', name=name, line=dict(color=color), yaxis='y2'))
+
+    return go.Figure(
+        data=data,
+        layout=go.Layout(
+            title='COVID-19 Cases and Stock Prices',
+            xaxis=dict(title='Date', range=[start, end]),
+            yaxis=dict(title='Total Confirmed Cases'),
+            yaxis2=dict(title='Stock Value', overlaying='y', side='right'),
         )
-    ),
-])
\ No newline at end of file
+    )
+
+
+def build_correlation_figure(correlations, start, end, window):
+    data = []
+    for column, name, color in stock_traces:
+        if column in correlations:
+            dates, values = column_points(correlations, column)
+            data.append(go.Scatter(x=dates, y=values, mode='lines', name=name, line=dict(color=color)))
+
+    return go.Figure(
+        data=data,
+        layout=go.Layout(
+            title=f'Rolling correlation of close price and new confirmed cases ({window} periods)',
+            xaxis=dict(title='Date', range=[start, end]),
+            yaxis=dict(title='Correlation', range=[-1, 1]),
+        )
+    )
+
+
+# Both figures for one (range, frequency, window); the dataset's build time is part of the key
+# so a background refresh is picked up
+@lru_cache(maxsize=64)
+def comparison_figures(built_at, start, end, freq, window):
+    frame = resample_frame(comparison_data.get()['frame'], start, end, freq)
+    correlations = rolling_correlations(frame, window)
+    return build_figure(frame, start, end), build_correlation_figure(correlations, start, end, window)
+
+
+def layout():
+    data = comparison_data.get()
+    first_date = data['frame'].index.min().strftime('%Y-%m-%d')
+    return html.Div([
+        html.Div([
+            dcc.DatePickerRange(
+                id='comparison-range',
+                min_date_allowed=first_date,
+                max_date_allowed=data['frame'].index.max().strftime('%Y-%m-%d'),
+                start_date=first_date,
+                end_date=data['max_stock_date_str'],
+                display_format='YYYY-MM-DD',
+            ),
+            dcc.RadioItems(
+                id='comparison-freq',
+                options=[{'label': label, 'value': key} for key, (label, _) in frequencies.items()],
+                value='D',
+                inline=True,
+            ),
+            html.Label('Correlation window (periods)'),
+            dcc.Input(id='comparison-window', type='number', min=3, max=365, step=1,
+                      value=default_window, debounce=True),
+        ], style={'margin': '20px'}),
+        dcc.Graph(id='combined-chart'),
+        dcc.Graph(id='comparison-correlation'),
+        html.Div([
+            html.A('Download CSV', href='/export/comparison?format=csv', className='btn btn-link'),
+            html.A('Download Parquet', href='/export/comparison?format=parquet', className='btn btn-link'),
+        ]),
+    ])
+
+
+@callback(
+    [Output('combined-chart', 'figure'),
+     Output('comparison-correlation', 'figure')],
+    [Input('comparison-range', 'start_date'),
+     Input('comparison-range', 'end_date'),
+     Input('comparison-freq', 'value'),
+     Input('comparison-window', 'value')]
+)
+def update_comparison(start_date, end_date, freq, window):
+    # Dates arrive as 'YYYY-MM-DD' or with a time part; only the day matters for the cache key
+    start = (start_date or '2020-01-22')[:10]
+    end = (end_date or comparison_data.get()['max_stock_date_str'])[:10]
+    window = max(int(window or default_window), 3)
+    return comparison_figures(comparison_data.built_at, start, end, freq or 'D', window)
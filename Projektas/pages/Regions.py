@@ -1,67 +1,81 @@
 import dash
-from dash import dcc, html
-import snowflake.connector
-import pandas as pd
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
+from dash import dcc, html, callback, Output, Input
 import plotly.express as px
 import json
+from clustering import FEATURE_SETS, K_VALUES, build_cluster_results
+from lazy_data import LazyDataset
+from shared_cache import memoize
 
 with open('config.json') as f:
     config = json.load(f)
 
 
-def fetch_data_from_snowflake(query):
-    sf_conn = snowflake.connector.connect(
-        user=config['SF_USER'],
-        password=config['SF_PASSWORD'],
-        account=config['SF_ACCOUNT'],
-        warehouse=config['SF_WAREHOUSE'],
-        database=config['SF_DATABASE'],
-        schema=config['SF_SCHEMA']
-    )
-    cursor = sf_conn.cursor()
-    cursor.execute(query)
-    columns = [desc[0] for desc in cursor.description]
-    rows = cursor.fetchall()
-    cursor.close()
-    sf_conn.close()
-
-    return pd.DataFrame(rows, columns=columns)
-
-
-confirmed_query = 'SELECT PROVINCE_STATE, MAX(CASES) AS CONFIRMED FROM JHU_COVID_19 WHERE CASE_TYPE = \'Confirmed\' GROUP BY PROVINCE_STATE'
-confirmed_data = fetch_data_from_snowflake(confirmed_query)
-
+refresh_interval = config.get('REGIONS_REFRESH_INTERVAL', 3600)
 
-deaths_query = 'SELECT PROVINCE_STATE, MAX(CASES) AS DEATHS FROM JHU_COVID_19 WHERE CASE_TYPE = \'Deaths\' GROUP BY PROVINCE_STATE'
-deaths_data = fetch_data_from_snowflake(deaths_query)
 
-data = pd.merge(confirmed_data, deaths_data, on='PROVINCE_STATE', how='inner')
-
-scaler = StandardScaler()
-scaled_data = scaler.fit_transform(data[['CONFIRMED', 'DEATHS']])
-
-num_clusters = 5
-kmeans = KMeans(n_clusters=num_clusters, random_state=42)
-clusters = kmeans.fit_predict(scaled_data)
+# Labels and silhouette scores for every k and feature choice, fitted in a process pool.
+# The result goes to the shared cache so only one worker process fits them per refresh interval.
+@memoize('regions-clusters', ttl=refresh_interval)
+def load_cluster_results():
+    return build_cluster_results(
+        workers=config.get('CLUSTER_WORKERS'),
+        minibatch_threshold=config.get('CLUSTER_MINIBATCH_THRESHOLD', 5000),
+    )
 
-data['Cluster'] = clusters
 
+cluster_data = LazyDataset('Regions clusters', load_cluster_results, refresh_interval=refresh_interval)
 
 external_css = ['https://cdn.jsdelivr.net/npm/bootstrap@5.3.1/dist/css/bootstrap.min.css']
 
 dash.register_page(__name__)
 title = 'COVID-19 Clustering Dashboard'
-layout = html.Div([
-    dcc.Graph(
-        id='scatter-plot',
-        figure=px.scatter(
-            data, x='CONFIRMED', y='DEATHS', color='Cluster',
-            hover_data=['PROVINCE_STATE', 'CONFIRMED', 'DEATHS', 'Cluster'],
-            labels={'CONFIRMED': 'Confirmed Cases', 'DEATHS': 'Deaths', 'PROVINCE_STATE': 'State'},
-            title='K-Means Clustering'
-        )
-    ),
-])
 
+default_k = 5
+
+
+def layout():
+    return html.Div([
+        html.Div([
+            html.Label('Features'),
+            dcc.RadioItems(
+                id='cluster-features',
+                options=[{'label': label, 'value': key} for key, (label, _) in FEATURE_SETS.items()],
+                value='cases_deaths',
+                inline=True,
+            ),
+            html.Label('Number of clusters'),
+            dcc.Slider(
+                id='cluster-k',
+                min=min(K_VALUES), max=max(K_VALUES), step=1, value=default_k,
+                marks={k: str(k) for k in K_VALUES},
+            ),
+        ], style={'margin': '20px'}),
+        html.Div(id='cluster-silhouette', style={'margin': '0 20px'}),
+        dcc.Graph(id='scatter-plot'),
+    ])
+
+
+@callback(
+    [Output('scatter-plot', 'figure'),
+     Output('cluster-silhouette', 'children')],
+    [Input('cluster-k', 'value'),
+     Input('cluster-features', 'value')]
+)
+def update_clusters(k, feature_key):
+    # Only picks precomputed labels, nothing is refitted per interaction
+    results = cluster_data.get()
+    result = results.get(feature_key, k)
+    if result is None:
+        return dash.no_update, f'No clustering with k={k} for these features'
+    labels, score = result
+
+    data = results.data.assign(Cluster=labels)
+    figure = px.scatter(
+        data, x='CONFIRMED', y='DEATHS', color='Cluster',
+        hover_data=['PROVINCE_STATE', 'CONFIRMED', 'DEATHS', 'Cluster'],
+        labels={'CONFIRMED': 'Confirmed Cases', 'DEATHS': 'Deaths', 'PROVINCE_STATE': 'State'},
+        title='K-Means Clustering'
+    )
+
+    best_k = max(results.silhouettes(feature_key).items(), key=lambda item: item[1])[0]
+    return figure, f'Silhouette score: {score:.3f} (best k for these features: {best_k})'
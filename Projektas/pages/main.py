@@ -1,11 +1,15 @@
 import dash
 from dash import Output, Input
-from dash import dcc, html, callback
-import snowflake.connector
+from dash import dcc, html, callback, clientside_callback, ClientsideFunction
 from pymongo import MongoClient
-from statsmodels.tsa.arima.model import ARIMA
-import pandas as pd
 import json
+import numpy as np
+from urllib.parse import quote
+from covid_data import get_country_series, get_country_kpis
+from forecasting import CASE_TYPES, forecast_dates, get_forecasts, start_precompute
+from country_index import country_index
+from shared_cache import memoize
+from client_payload import build_country_payload
 
 with open('config.json') as f:
     config = json.load(f)
@@ -13,55 +17,20 @@ with open('config.json') as f:
 # Mongodb connection
 mongo_client = MongoClient(f"mongodb+srv://{config['MONGO_USERNAME']}:{config['MONGO_PASSWORD']}@{config['MONGO_CLUSTER']}/?retryWrites=true&w=majority")
 
+# Country switching, KPIs and trace toggles run in the browser from one preloaded payload
+clientside_mode = config.get('CLIENTSIDE_COUNTRY_SWITCHING', False)
+trace_names = [name for case_type in CASE_TYPES for name in (case_type, f'{case_type} Forecast')]
+
 db = mongo_client['Covid']
 external_css = ['https://cdn.jsdelivr.net/npm/bootstrap@5.3.1/dist/css/bootstrap.min.css']
 
 dash.register_page(__name__)
 
-# Snowflake connection
-def get_snowflake_connection(config):
-    return snowflake.connector.connect(
-        user=config['SF_USER'],
-        password=config['SF_PASSWORD'],
-        account=config['SF_ACCOUNT'],
-        warehouse=config['SF_WAREHOUSE'],
-        database=config['SF_DATABASE'],
-        schema=config['SF_SCHEMA']
-    )
-
-
-# Arima forecasting
-def forecast_time_series(x, y, forecast_steps=60):
-    model = ARIMA(y, order=(1, 1, 0))
-    fitted_model = model.fit()
-
-    forecast_values = fitted_model.forecast(steps=forecast_steps)
-
-    future_dates = pd.date_range(start=x[-1], periods=forecast_steps + 1, freq='D')[1:]
-    extended_x = x + list(future_dates)
-
-    return extended_x, list(y) + list(forecast_values)
-
-
-# Query Snowflake for data in a specific country
-def query_snowflake(country):
-    sf_conn = get_snowflake_connection(config)
-    cursor = sf_conn.cursor()
-    cursor.execute('SELECT * FROM JHU_COVID_19 WHERE COUNTRY_REGION = %s', (country,))
-    columns = [desc[0] for desc in cursor.description]
-    rows = cursor.fetchall()
-    cursor.close()
-    sf_conn.close()
-
-    result = []
-    for row in rows:
-        result.append(dict(zip(columns, row)))
-
-    return result
-
-
 dash.register_page(__name__, path='/')
 
+# Refit every country's forecast in the background so the chart callback only does a lookup
+start_precompute()
+
 layout = html.Div(children=[
     html.Div(
         id='info-container',
@@ -146,151 +115,143 @@ layout = html.Div(children=[
         value='Lithuania',
         multi=False
     ),
+    # Never updated, only triggers the one-time dropdown fill when the page loads
+    dcc.Store(id='country-index-store'),
+    # Every country's series and forecasts, filled once per page load in client-side mode
+    dcc.Store(id='country-payload'),
+    dcc.Checklist(id='case-type-toggle', options=trace_names, value=trace_names, inline=True,
+                  style={} if clientside_mode else {'display': 'none'}),
 
     dcc.Graph(id='covid-line-chart'),
+    html.Div([
+        html.A('Download CSV', id='country-export-csv', className='btn btn-link'),
+        html.A('Download Parquet', id='country-export-parquet', className='btn btn-link'),
+    ]),
 ])
 
 
 @callback(
-    [Output(f'kpi-{i}', 'children') for i in range(1, 5)],
-    [Input('country-dropdown', 'value')]
+    Output('country-dropdown', 'options'),
+    [Input('country-index-store', 'data')]
 )
-def update_kpis(selected_country):
-    # checking if country is selected
-    if selected_country:
-        # making connection to snowflake
-        sf_conn = get_snowflake_connection(config)
-        cursor = sf_conn.cursor()
-
-        # SQL query
-        queries = [
-            "SELECT MAX(CASES) AS TOTAL_CONFIRMED FROM JHU_COVID_19"
-            " WHERE CASE_TYPE = 'Confirmed' AND COUNTRY_REGION = %s",
-            "SELECT MAX(CASES) AS TOTAL_DEATHS FROM JHU_COVID_19"
-            " WHERE CASE_TYPE = 'Deaths' AND COUNTRY_REGION = %s",
-            "SELECT MAX(CASES) AS TOTAL_ACTIVE FROM JHU_COVID_19"
-            " WHERE CASE_TYPE = 'Active' AND COUNTRY_REGION = %s",
-            "SELECT MAX(CASES) AS TOTAL_RECOVERED FROM JHU_COVID_19"
-            " WHERE CASE_TYPE = 'Recovered' AND COUNTRY_REGION = %s"
-        ]
+def update_dropdown_options(_):
+    # Sorted options served from the in-memory country index, no query per selection
+    return country_index.options()
 
-        # labels for KPIs
-        labels = ["Confirmed", "Deaths", "Active", "Recovered"]
 
-        results = []    # Storing results for each KPI in a list
-        for i, query in enumerate(queries, start=1):
-            # Executing SQL query
-            cursor.execute(query, (selected_country,))
-            total_value = cursor.fetchone()[0]  # Fetching results of query
-            kpi_label = f"Total {labels[i-1]}: "    # Making KPI label
-            results.append([
-                html.H3(kpi_label,
-                        style={'textAlign': 'center', 'color': 'white', 'fontWeight': 'bold', 'fontSize': '25px'}),
-                html.Div(f"{int(total_value)}",
-                         style={'textAlign': 'center', 'color': 'white', 'fontWeight': 'bold', 'fontSize': '25px'})
-            ])
+# Plotly's default colours, so a forecast and its band match the case type they belong to
+# (assets/clientside.js uses the same ones)
+trace_colors = {'Confirmed': '#636efa', 'Deaths': '#ef553b', 'Active': '#00cc96', 'Recovered': '#ab63fa'}
 
-        cursor.close()
-        sf_conn.close()
 
-        return results
+def _rgba(color, alpha):
+    return f'rgba({int(color[1:3], 16)}, {int(color[3:5], 16)}, {int(color[5:7], 16)}, {alpha})'
 
 
-@callback(
-    Output('country-dropdown', 'options'),
-    [Input('country-dropdown', 'value')]
-)
-def update_dropdown_options(selected_country):
-    # Fetch distinct countries from Snowflake
-    query = 'SELECT DISTINCT COUNTRY_REGION FROM JHU_COVID_19'
-    sf_conn = get_snowflake_connection(config)
-    cursor = sf_conn.cursor()
-    cursor.execute(query)
-    countries = [row[0] for row in cursor.fetchall()]
-    cursor.close()
-    sf_conn.close()
+# Dashed forecast starting at the last observed day, with its prediction interval as a shaded band
+def forecast_traces(case_type, x_values, y_values, forecast):
+    x = np.concatenate([np.asarray(x_values[-1:], dtype='datetime64[D]'), forecast_dates(x_values, len(forecast.values))])
+    last = [float(y_values[-1])]
+    name = f'{case_type} Forecast'
+    band = {'type': 'line', 'x': x, 'legendgroup': name, 'showlegend': False, 'hoverinfo': 'skip',
+            'line': {'width': 0}}
+    return [
+        dict(band, y=last + list(forecast.lower), name=f'{name} lower'),
+        dict(band, y=last + list(forecast.upper), name=f'{name} upper', fill='tonexty',
+             fillcolor=_rgba(trace_colors[case_type], 0.2)),
+        {'x': x, 'y': last + list(forecast.values), 'type': 'line', 'name': name, 'legendgroup': name,
+         'line': {'color': trace_colors[case_type], 'dash': 'dash' if forecast.mode != 'fallback' else 'dot'}},
+    ]
 
-    # Format options for the dropdown
-    options = [{'label': country, 'value': country} for country in countries]
 
-    return options
+if not clientside_mode:
+    @callback(
+        [Output(f'kpi-{i}', 'children') for i in range(1, 5)],
+        [Input('country-dropdown', 'value')]
+    )
+    @memoize('update_kpis', ttl=300)
+    def update_kpis(selected_country):
+        # checking if country is selected
+        if selected_country:
+            # KPIs are derived from the same cached series the chart uses
+            totals = get_country_kpis(selected_country)
+
+            # labels for KPIs
+            labels = ["Confirmed", "Deaths", "Active", "Recovered"]
+
+            results = []    # Storing results for each KPI in a list
+            for label in labels:
+                kpi_label = f"Total {label}: "    # Making KPI label
+                results.append([
+                    html.H3(kpi_label,
+                            style={'textAlign': 'center', 'color': 'white', 'fontWeight': 'bold', 'fontSize': '25px'}),
+                    html.Div(f"{int(totals[label])}",
+                             style={'textAlign': 'center', 'color': 'white', 'fontWeight': 'bold', 'fontSize': '25px'})
+                ])
+
+            return results
+
+    @callback(
+        Output('covid-line-chart', 'figure'),
+        [Input('country-dropdown', 'value')]
+    )
+    @memoize('update_data', ttl=300)
+    def update_data(selected_country):
+        # Fetch snowflake data for the specific country, one parameterized query shared with the KPIs
+        series = get_country_series(selected_country)
+
+        # Date and value arrays straight from the series store, no per-row Python lists
+        case_series = {case_type: (series[case_type].dates, series[case_type].values) for case_type in CASE_TYPES}
+
+        # Forecasts for every case type, fitted side by side; slow fits come back as a drift forecast
+        forecasts = get_forecasts(selected_country, case_series, forecast_steps=30)
+
+        # Defining traces for every case type, its forecast and the forecast's prediction interval
+        traces = []
+        for case_type in CASE_TYPES:
+            x_values, y_values = case_series[case_type]
+            traces.append({'x': x_values, 'y': y_values, 'type': 'line', 'name': case_type,
+                           'line': {'color': trace_colors[case_type]}})
+            forecast = forecasts.get(case_type)
+            if forecast is not None:
+                traces.extend(forecast_traces(case_type, x_values, y_values, forecast))
+
+        new_figure = {
+            'data': traces,
+            'layout': {
+                'title': f'COVID-19 Confirmed Cases and Deaths Over Time - {selected_country}',
+                'xaxis': {'title': 'Date'},
+                'yaxis': {'title': 'Cases'},
+            }
+        }
+
+        return new_figure
+
+else:
+    clientside_callback(
+        ClientsideFunction(namespace='covid', function_name='updateCountry'),
+        [Output(f'kpi-{i}', 'children') for i in range(1, 5)] + [Output('covid-line-chart', 'figure')],
+        [Input('country-dropdown', 'value'),
+         Input('country-payload', 'data'),
+         Input('case-type-toggle', 'value')]
+    )
+
+    @callback(
+        Output('country-payload', 'data'),
+        [Input('country-index-store', 'data')]
+    )
+    @memoize('country-payload', ttl=300)
+    def load_country_payload(_):
+        # Compact series for every country; the only server round trip of the page in this mode
+        return build_country_payload()
 
 
 @callback(
-    Output('covid-line-chart', 'figure'),
+    [Output('country-export-csv', 'href'),
+     Output('country-export-parquet', 'href')],
     [Input('country-dropdown', 'value')]
 )
-def update_data(selected_country):
-    # Fetch snowflake data for the specific country
-
-    # SQL query
-    confirmed_query = f"SELECT DATE, MAX(CASES) AS TOTAL_CONFIRMED FROM JHU_COVID_19 WHERE CASE_TYPE = 'Confirmed'" \
-                      f" AND COUNTRY_REGION = '{selected_country}' GROUP BY DATE ORDER BY DATE"
-    deaths_query = f"SELECT DATE, MAX(CASES) AS TOTAL_DEATHS FROM JHU_COVID_19 WHERE CASE_TYPE = 'Deaths'" \
-                   f" AND COUNTRY_REGION = '{selected_country}' GROUP BY DATE ORDER BY DATE"
-    active_query = f"SELECT DATE, MAX(CASES) AS TOTAL_DEATHS FROM JHU_COVID_19 WHERE CASE_TYPE = 'Active'" \
-                   f" AND COUNTRY_REGION = '{selected_country}' GROUP BY DATE ORDER BY DATE"
-    recovered_query = f"SELECT DATE, MAX(CASES) AS TOTAL_DEATHS FROM JHU_COVID_19 WHERE CASE_TYPE = 'Recovered'" \
-                      f" AND COUNTRY_REGION = '{selected_country}' GROUP BY DATE ORDER BY DATE"
-
-    # Making connection to snowflake
-    sf_conn = get_snowflake_connection(config)
-
-    # Creating cursors to execute queries
-    cursor_confirmed = sf_conn.cursor()
-    cursor_deaths = sf_conn.cursor()
-    cursor_active = sf_conn.cursor()
-    cursor_recovered = sf_conn.cursor()
-
-    # Queries to fetch data for every case type
-    cursor_confirmed.execute(confirmed_query)
-    cursor_deaths.execute(deaths_query)
-    cursor_active.execute(active_query)
-    cursor_recovered.execute(recovered_query)
-
-    # Fetching results for every case type
-    confirmed_data = cursor_confirmed.fetchall()
-    deaths_data = cursor_deaths.fetchall()
-    active_data = cursor_active.fetchall()
-    recovered_data = cursor_recovered.fetchall()
-
-    # Closing cursors
-    cursor_confirmed.close()
-    cursor_deaths.close()
-    cursor_active.close()
-    cursor_recovered.close()
-    sf_conn.close()
-
-    # Extract x and y values for the COVID-19 charts
-    confirmed_x_values = [row[0] for row in confirmed_data]
-    confirmed_y_values = [row[1] for row in confirmed_data]
-
-    deaths_x_values = [row[0] for row in deaths_data]
-    deaths_y_values = [row[1] for row in deaths_data]
-
-    active_x_values = [row[0] for row in active_data]
-    active_y_values = [row[1] for row in active_data]
-
-    recovered_x_values = [row[0] for row in recovered_data]
-    recovered_y_values = [row[1] for row in recovered_data]
-
-    # Forecasting for confirmed cases
-    confirmed_x_values_forecast, confirmed_y_values_forecast = forecast_time_series(confirmed_x_values, confirmed_y_values, forecast_steps=30)
-
-    # Defining traces for every case type and forecasting
-    trace_confirmed = {'x': confirmed_x_values, 'y': confirmed_y_values, 'type': 'line', 'name': 'Confirmed'}
-    trace_confirmed_forecast = {'x': confirmed_x_values_forecast, 'y': confirmed_y_values_forecast, 'type': 'line', 'name': 'Confirmed Forecast'}
-    trace_deaths = {'x': deaths_x_values, 'y': deaths_y_values, 'type': 'line', 'name': 'Deaths'}
-    trace_active = {'x': active_x_values, 'y': active_y_values, 'type': 'line', 'name': 'Active'}
-    trace_recovered = {'x': recovered_x_values, 'y': recovered_y_values, 'type': 'line', 'name': 'Recovered'}
-
-    new_figure = {
-        'data': [trace_confirmed, trace_confirmed_forecast, trace_deaths, trace_active, trace_recovered],
-        'layout': {
-            'title': f'COVID-19 Confirmed Cases and Deaths Over Time - {selected_country}',
-            'xaxis': {'title': 'Date'},
-            'yaxis': {'title': 'Cases'},
-        }
-    }
-
-    return new_figure
+def update_export_links(selected_country):
+    # Files are streamed by the /export routes, nothing is sent through the callback
+    country = quote(selected_country or '')
+    return f'/export/country?country={country}&format=csv', f'/export/country?country={country}&format=parquet'
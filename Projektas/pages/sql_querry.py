@@ -1,8 +1,9 @@
 import dash
 from dash import Output, Input, State
 from dash import dcc, html, dash_table, callback
-import snowflake.connector
 import json
+import uuid
+from query_results import get_result_store
 
 with open('config.json') as f:
     config = json.load(f)
@@ -11,78 +12,110 @@ external_css = ['https://cdn.jsdelivr.net/npm/bootstrap@5.3.1/dist/css/bootstrap
 
 dash.register_page(__name__)
 
-layout = html.Div([
-    dcc.Textarea(
-        id='sql-input',
-        placeholder='Enter SQL query...',
-        style={'width': '100%', 'height': 100, 'font-family': 'Courier New, monospace'},
-    ),
-    html.Button('Execute Query', id='execute-button', className='btn btn-primary'),
-    html.Button('Remove Table', id='remove-table-button', className='btn btn-danger'),
-    html.Div([
-        html.Div(id='query-output'),
-        dash_table.DataTable(
-            id='table-output',
-            style_table={'font-family': 'Arial, sans-serif'},
-            style_header={
-                'backgroundColor': 'lightgrey',
-                'fontWeight': 'bold'
-            },
-            style_cell={
-                'textAlign': 'left',
-                'minWidth': '50px', 'maxWidth': '180px',
-                'whiteSpace': 'normal',
-                'overflow': 'hidden',
-                'textOverflow': 'ellipsis',
-            },
+PAGE_SIZE = 25
+
+
+def layout():
+    session_id = str(uuid.uuid4())
+    return html.Div([
+        # Identifies this browser tab's result buffer on the server
+        dcc.Store(id='sql-session', data=session_id),
+        dcc.Store(id='sql-result-version'),
+        dcc.Textarea(
+            id='sql-input',
+            placeholder='Enter SQL query...',
+            style={'width': '100%', 'height': 100, 'font-family': 'Courier New, monospace'},
         ),
+        html.Button('Execute Query', id='execute-button', className='btn btn-primary'),
+        html.Button('Remove Table', id='remove-table-button', className='btn btn-danger'),
+        # Results of read-only queries are streamed by /export/sql, up to SQL_MAX_ROWS rows
+        html.A('Download CSV', href=f'/export/sql?session={session_id}&format=csv', className='btn btn-link'),
+        html.A('Download Parquet', href=f'/export/sql?session={session_id}&format=parquet', className='btn btn-link'),
+        html.Div([
+            html.Div(id='query-output'),
+            dash_table.DataTable(
+                id='table-output',
+                columns=[],
+                # Paging, sorting and filtering run on the server over the buffered result
+                page_action='custom',
+                page_current=0,
+                page_size=PAGE_SIZE,
+                sort_action='custom',
+                sort_mode='multi',
+                sort_by=[],
+                filter_action='custom',
+                filter_query='',
+                style_table={'font-family': 'Arial, sans-serif'},
+                style_header={
+                    'backgroundColor': 'lightgrey',
+                    'fontWeight': 'bold'
+                },
+                style_cell={
+                    'textAlign': 'left',
+                    'minWidth': '50px', 'maxWidth': '180px',
+                    'whiteSpace': 'normal',
+                    'overflow': 'hidden',
+                    'textOverflow': 'ellipsis',
+                },
+            ),
+        ])
     ])
-])
 
 
 @callback(
     [Output('query-output', 'children'),
-     Output('table-output', 'data')],
+     Output('sql-result-version', 'data'),
+     Output('table-output', 'columns'),
+     Output('table-output', 'page_current')],
     [Input('execute-button', 'n_clicks'),
      Input('remove-table-button', 'n_clicks')],
-    [State('sql-input', 'value')]
+    [State('sql-input', 'value'),
+     State('sql-session', 'data')]
 )
-def execute_sql_query_or_remove_table(n_clicks_execute, n_clicks_remove, sql_query):
+def execute_sql_query_or_remove_table(n_clicks_execute, n_clicks_remove, sql_query, session_id):
     ctx = dash.callback_context
 
     if not ctx.triggered_id:
         raise dash.exceptions.PreventUpdate
 
-    if 'execute-button' in ctx.triggered_id:
-        # Connect to Snowflake database
-        sf_conn = snowflake.connector.connect(
-            user=config['SF_USER'],
-            password=config['SF_PASSWORD'],
-            account=config['SF_ACCOUNT'],
-            warehouse=config['SF_WAREHOUSE'],
-            database=config['SF_DATABASE'],
-            schema=config['SF_SCHEMA']
-        )
-        cursor = sf_conn.cursor()
+    store = get_result_store()
 
+    if 'execute-button' in ctx.triggered_id:
+        # Rows are fetched in batches into this session's bounded buffer
         try:
-            cursor.execute(sql_query)
-            columns = [desc[0] for desc in cursor.description]
-            rows = cursor.fetchall()
-            data = [dict(zip(columns, row)) for row in rows]
-            query_output = f"Query: {sql_query}"
-            return query_output, data
-
+            buffer = store.run(session_id, sql_query)
         except Exception as e:
             error_message = f"Error executing SQL query: {e}"
-            return error_message, []
+            return error_message, None, [], 0
 
-        finally:
-            # Closing database connection
-            cursor.close()
-            sf_conn.close()
+        if buffer.frame is None:
+            return "Query cancelled", None, [], 0
+
+        query_output = f"Query: {sql_query} ({len(buffer.frame)} rows"
+        if buffer.truncated:
+            query_output += f", limited to the first {store.max_rows}"
+        query_output += ")"
+        query_output += {'cache': " - cache hit", 'shared': " - shared with a running query"}.get(buffer.source, " - cache miss")
+        columns = [{'name': str(column), 'id': str(column)} for column in buffer.frame.columns]
+        return query_output, buffer.version, columns, 0
 
     elif 'remove-table-button' in ctx.triggered_id:
-        # returning empty data to remove the table
-        return "", []
+        # cancelling a running query and dropping the buffered rows removes the table
+        store.cancel(session_id)
+        return "", None, [], 0
+
 
+@callback(
+    [Output('table-output', 'data'),
+     Output('table-output', 'page_count')],
+    [Input('sql-result-version', 'data'),
+     Input('table-output', 'page_current'),
+     Input('table-output', 'page_size'),
+     Input('table-output', 'sort_by'),
+     Input('table-output', 'filter_query')],
+    [State('sql-session', 'data')]
+)
+def update_table_page(result_version, page_current, page_size, sort_by, filter_query, session_id):
+    if result_version is None:
+        return [], 1
+    return get_result_store().page(session_id, page_current or 0, page_size, sort_by, filter_query, result_version)
@@ -0,0 +1,117 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+_literals_and_comments = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"]|\"\")*\"|\$\$.*?\$\$|--[^\n]*|//[^\n]*|/\*.*?\*/", re.S)
+_around_operators = re.compile(r'\s*([^\w\s]+)\s*')
+_word = re.compile(r'\w')
+_cacheable = re.compile(r'^\s*(select|with|show|describe|desc)\b', re.I)
+
+
+# Cache key for a query: comments removed, whitespace collapsed and case folded outside quotes and
+# $$...$$ constants. Whitespace around operators and punctuation is dropped, so "a='X'", "a = 'X'"
+# and "a= 'X'" give one key; a single space only stays between two words, or a word and a literal.
+def normalize_sql(sql):
+    pieces = []
+    code = []
+    pos = 0
+    for match in _literals_and_comments.finditer(sql):
+        code.append(sql[pos:match.start()])
+        token = match.group()
+        if token[0] in '\'"$':
+            pieces.append(_normalize_code(''.join(code)))
+            pieces.append(token)
+            code = []
+        else:
+            code.append(' ')
+        pos = match.end()
+    code.append(sql[pos:])
+    pieces.append(_normalize_code(''.join(code)))
+
+    normalized = ''
+    for i, piece in enumerate(pieces):
+        if not piece:
+            continue
+        # pieces alternate code, literal, code...; a word next to a literal keeps its space
+        is_literal = i % 2 == 1
+        boundary = piece[0] if not is_literal else normalized[-1:]
+        if normalized and _word.match(boundary):
+            normalized += ' '
+        normalized += piece
+    return normalized.rstrip(';')
+
+
+def _normalize_code(code):
+    code = ' '.join(code.split()).lower()
+    return _around_operators.sub(r'\1', code).strip()
+
+
+def is_cacheable(sql):
+    return bool(sql and _cacheable.match(_literals_and_comments.sub(' ', sql)))
+
+
+def _to_compact(frame):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return frame, int(frame.memory_usage(deep=True).sum())
+    try:
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # mixed-type object columns stay as a pandas frame
+        return frame, int(frame.memory_usage(deep=True).sum())
+    return table, table.nbytes
+
+
+def _to_frame(stored):
+    return stored.to_pandas() if hasattr(stored, 'to_pandas') else stored
+
+
+# LRU cache of query results held as Arrow tables, bounded by total bytes and entry age
+class QueryResultCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024, ttl=600.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    # (frame, truncated); arrow=True returns the stored Arrow table as is (a frame if it never converted)
+    def get(self, key, arrow=False):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            _, stored, size, truncated = entry
+        return (stored if arrow else _to_frame(stored)), truncated
+
+    def set(self, key, frame, truncated=False):
+        stored, size = _to_compact(frame)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, stored, size, truncated)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.stats['evictions'] += 1
+
+    def _remove(self, key):
+        _, _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
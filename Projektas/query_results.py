@@ -0,0 +1,343 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import pandas as pd
+
+from cache_utils import SingleFlight
+from query_cache import QueryResultCache, is_cacheable, normalize_sql
+from settings import load_config
+from shared_cache import cache_key, get_shared_cache
+from snapshot import get_snapshot, is_offline
+from snowflake_pool import get_pool, get_sql_pool
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+# Arrow backed pandas batches when the connector has them, plain fetchmany otherwise
+def cursor_batches(cursor, batch_size=10000):
+    columns = [desc[0] for desc in cursor.description]
+    fetch_batches = getattr(cursor, 'fetch_pandas_batches', None)
+    if fetch_batches is not None:
+        try:
+            for batch in fetch_batches():
+                yield batch
+            return
+        except Exception as e:
+            if type(e).__name__ != 'NotSupportedError':
+                raise
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield pd.DataFrame(rows, columns=columns)
+
+
+# Rows of one session's last query, capped at max_rows
+class ResultBuffer:
+    __slots__ = ('session_id', 'sql', 'frame', 'truncated', 'cancelled', 'query_id', 'version', 'source')
+
+    def __init__(self, session_id, sql, version):
+        self.session_id = session_id
+        self.sql = sql
+        self.frame = None
+        self.truncated = False
+        self.source = None     # 'cache', 'shared' (another session's in-flight run) or 'warehouse'
+        self.cancelled = threading.Event()
+        self.query_id = None
+        self.version = version
+
+
+# Bounded per-session result buffers for the SQL page, filled batch by batch from the cursor.
+# Finished results and running query ids are also published to the shared cache for
+# session_ttl seconds, so paging, exports and cancels work from any worker process.
+class ResultStore:
+    def __init__(self, max_rows=100000, timeout=120, max_sessions=20, batch_size=10000, cache=None,
+                 session_ttl=3600):
+        self.max_rows = max_rows
+        self.cache = cache
+        self._in_flight = SingleFlight()
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        self.batch_size = batch_size
+        self.session_ttl = session_ttl
+        self._lock = threading.Lock()
+        self._buffers = OrderedDict()
+
+    def _install(self, session_id, buffer):
+        with self._lock:
+            previous = self._buffers.pop(session_id, None)
+            self._buffers[session_id] = buffer
+            while len(self._buffers) > self.max_sessions:
+                _, evicted = self._buffers.popitem(last=False)
+                evicted.cancelled.set()
+        return previous
+
+    def _new_buffer(self, session_id, sql):
+        # versions are unique across worker processes, pages ask for the one they were given
+        buffer = ResultBuffer(session_id, sql, uuid.uuid4().hex)
+        previous = self._install(session_id, buffer)
+        if previous is not None:
+            self._cancel_buffer(previous)
+        # the session's previous query may be running in another worker process
+        self._cancel_shared(session_id)
+        return buffer
+
+    def _result_key(self, session_id):
+        return cache_key('sql-result', (session_id,), {})
+
+    def _running_key(self, session_id):
+        return cache_key('sql-running', (session_id,), {})
+
+    def _publish(self, buffer):
+        if buffer.frame is not None:
+            get_shared_cache().set(self._result_key(buffer.session_id),
+                                   (buffer.version, buffer.sql, buffer.frame, buffer.truncated, buffer.source),
+                                   ttl=self.session_ttl)
+
+    def _load_shared(self, session_id):
+        entry = get_shared_cache().get(self._result_key(session_id))
+        if entry is None:
+            return None
+        version, sql, frame, truncated, source = entry
+        buffer = ResultBuffer(session_id, sql, version)
+        buffer.frame, buffer.truncated, buffer.source = frame, truncated, source
+        return buffer
+
+    # The session's result with the given version, or its latest one when version is None; from
+    # this process or from the shared cache when another worker ran it
+    def get(self, session_id, version=None):
+        with self._lock:
+            buffer = self._buffers.get(session_id)
+            if buffer is not None:
+                self._buffers.move_to_end(session_id)
+        if buffer is not None and version is not None and buffer.version == version:
+            return buffer
+        shared = self._load_shared(session_id)
+        if shared is None or (buffer is not None and shared.version == buffer.version):
+            return buffer
+        if version is None or shared.version == version or buffer is None:
+            # a query still running here is left in place so it can be cancelled
+            if buffer is None or buffer.frame is not None:
+                self._install(session_id, shared)
+            return shared
+        return buffer
+
+    def _fill(self, buffer, batches):
+        frames = []
+        count = 0
+        for batch in batches:
+            if buffer.cancelled.is_set():
+                raise QueryCancelled()
+            frames.append(batch)
+            count += len(batch)
+            if count >= self.max_rows:
+                buffer.truncated = True
+                break
+        frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        return frame.iloc[:self.max_rows]
+
+    # Poll an asynchronously submitted query so it can be cancelled or timed out while running
+    def _wait(self, conn, buffer):
+        deadline = time.monotonic() + self.timeout
+        while conn.is_still_running(conn.get_query_status_throw_if_error(buffer.query_id)):
+            if buffer.cancelled.is_set():
+                raise QueryCancelled()
+            if time.monotonic() > deadline:
+                self._cancel_buffer(buffer)
+                raise QueryTimeout(f'Query did not finish within {self.timeout}s and was cancelled')
+            time.sleep(0.2)
+
+    # Execute on the warehouse (or the offline snapshot), returns (frame, truncated); frame is None when cancelled
+    def _execute(self, buffer, sql):
+        if is_offline() and get_snapshot() is not None:
+            columns, rows = get_snapshot().query(sql)
+            return pd.DataFrame(rows[:self.max_rows], columns=columns), len(rows) > self.max_rows
+
+        with get_sql_pool().connection(reuse=False) as conn:
+            with conn.cursor() as cursor:
+                try:
+                    cursor.execute_async(sql)
+                    buffer.query_id = cursor.sfqid
+                    get_shared_cache().set(self._running_key(buffer.session_id), buffer.query_id,
+                                           ttl=self.timeout + 60)
+                    self._wait(conn, buffer)
+                    cursor.get_results_from_sfqid(buffer.query_id)
+                    if cursor.description is None:
+                        return pd.DataFrame(), False
+                    frame = self._fill(buffer, cursor_batches(cursor, self.batch_size))
+                    return frame, buffer.truncated
+                except QueryCancelled:
+                    return None, False
+                finally:
+                    if buffer.query_id:
+                        get_shared_cache().delete(self._running_key(buffer.session_id))
+                    buffer.query_id = None
+
+    # Run the query for a session, replacing (and cancelling) its previous result. Read-only
+    # queries are served from the result cache, and identical queries running at the same time
+    # share one execution.
+    def run(self, session_id, sql):
+        buffer = self._run(self._new_buffer(session_id, sql), sql)
+        self._publish(buffer)
+        return buffer
+
+    def _run(self, buffer, sql):
+
+        key = normalize_sql(sql) if self.cache is not None and is_cacheable(sql) else None
+        if key is None:
+            buffer.frame, buffer.truncated = self._execute(buffer, sql)
+            buffer.source = 'warehouse'
+            return buffer
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            buffer.frame, buffer.truncated = cached
+            buffer.source = 'cache'
+            return buffer
+
+        (frame, truncated), shared = self._in_flight.do_shared(key, self._execute, buffer, sql)
+        if frame is None and shared and not buffer.cancelled.is_set():
+            # the session that ran it was cancelled, run it for this one instead
+            (frame, truncated), shared = self._execute(buffer, sql), False
+        if frame is not None and not shared:
+            self.cache.set(key, frame, truncated)
+        buffer.frame, buffer.truncated = frame, truncated
+        buffer.source = 'shared' if shared else 'warehouse'
+        return buffer
+
+    def _cancel_query(self, query_id):
+        try:
+            with get_pool().cursor() as cursor:
+                cursor.execute('SELECT SYSTEM$CANCEL_QUERY(%s)', (query_id,))
+        except Exception as e:
+            print(f'Cancelling query {query_id} failed: {e}')
+
+    def _cancel_buffer(self, buffer):
+        buffer.cancelled.set()
+        if buffer.query_id:
+            self._cancel_query(buffer.query_id)
+
+    # A query of this session running in another worker process is cancelled on the warehouse
+    def _cancel_shared(self, session_id):
+        cache = get_shared_cache()
+        query_id = cache.get(self._running_key(session_id))
+        if query_id:
+            self._cancel_query(query_id)
+            cache.delete(self._running_key(session_id))
+
+    # Stop the session's running query and drop its rows, in every worker process
+    def cancel(self, session_id):
+        with self._lock:
+            buffer = self._buffers.pop(session_id, None)
+        if buffer is not None:
+            self._cancel_buffer(buffer)
+        self._cancel_shared(session_id)
+        get_shared_cache().delete(self._result_key(session_id))
+
+    def page(self, session_id, page_current, page_size, sort_by=None, filter_query=None, version=None):
+        buffer = self.get(session_id, version)
+        if buffer is None or buffer.frame is None:
+            return [], 1
+        frame = apply_filter(buffer.frame, filter_query)
+        if sort_by:
+            frame = apply_sort(frame, sort_by)
+        page_count = max(1, -(-len(frame) // page_size))
+        start = page_current * page_size
+        return frame.iloc[start:start + page_size].to_dict('records'), page_count
+
+
+filter_operators = [['ge ', '>='], ['le ', '<='], ['lt ', '<'], ['gt ', '>'], ['ne ', '!='], ['eq ', '='],
+                    ['contains '], ['datestartswith ']]
+
+
+# Parse one DataTable filter expression such as "{CASES} > 100"
+def split_filter_part(filter_part):
+    for operator_type in filter_operators:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+
+                value_part = value_part.strip()
+                v0 = value_part[0] if value_part else ''
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = value_part[1: -1].replace('\\' + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+
+                return name, operator_type[0].strip(), value
+
+    return [None] * 3
+
+
+def apply_filter(frame, filter_query):
+    if not filter_query:
+        return frame
+    for filter_part in filter_query.split(' && '):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if col_name not in frame:
+            continue
+        column = frame[col_name]
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            try:
+                mask = getattr(column, operator)(filter_value)
+            except TypeError:
+                # a number against a text column (or the other way round): compared as text
+                try:
+                    mask = getattr(column.astype(str), operator)(_filter_text(filter_value))
+                except TypeError:
+                    continue
+            frame = frame.loc[mask]
+        elif operator == 'contains':
+            frame = frame.loc[column.astype(str).str.contains(str(filter_value), regex=False)]
+        elif operator == 'datestartswith':
+            frame = frame.loc[column.astype(str).str.startswith(str(filter_value))]
+    return frame
+
+
+def _filter_text(value):
+    return str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+
+
+# Sort by the DataTable's sort_by; columns mixing types (numbers and text) are sorted as text
+def apply_sort(frame, sort_by):
+    columns = [col['column_id'] for col in sort_by if col['column_id'] in frame]
+    ascending = [col['direction'] == 'asc' for col in sort_by if col['column_id'] in frame]
+    if not columns:
+        return frame
+    try:
+        return frame.sort_values(columns, ascending=ascending, inplace=False)
+    except TypeError:
+        return frame.sort_values(columns, ascending=ascending, inplace=False,
+                                 key=lambda column: column.astype(str) if column.dtype == object else column)
+
+
+_store = None
+
+
+def get_result_store():
+    global _store
+    if _store is None:
+        config = load_config()
+        _store = ResultStore(
+            max_rows=config.get('SQL_MAX_ROWS', 100000),
+            timeout=config.get('SQL_QUERY_TIMEOUT', 120),
+            max_sessions=config.get('SQL_MAX_SESSIONS', 20),
+            session_ttl=config.get('SQL_SESSION_TTL', 3600),
+            cache=QueryResultCache(
+                max_bytes=config.get('SQL_CACHE_BYTES', 256 * 1024 * 1024),
+                ttl=config.get('SQL_CACHE_TTL', 600),
+            ),
+        )
+    return _store
@@ -0,0 +1,146 @@
+import datetime
+import threading
+import time
+
+from settings import load_config
+from shared_cache import get_shared_cache
+from snapshot import DATA_VERSION_QUERY, SOURCE_TABLE
+from snowflake_pool import get_pool
+
+
+# JHU_COVID_19 reduced to one row per (country, province, case type, date) holding MAX(CASES).
+# Only the days at or after the stored watermark (minus a lookback for late corrections) are rebuilt.
+class DailyRollup:
+    def __init__(self, table, source=SOURCE_TABLE, lookback_days=3):
+        self.table = table
+        self.source = source
+        self.lookback_days = lookback_days
+        self.ready = False
+        self.watermark = None
+        self.last_refresh = None
+        self.last_refresh_rows = 0
+        self.last_refresh_seconds = None
+        self._lock = threading.Lock()
+
+    def _create(self, cursor):
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.table} (
+                COUNTRY_REGION VARCHAR,
+                PROVINCE_STATE VARCHAR,
+                CASE_TYPE VARCHAR,
+                DATE DATE,
+                CASES NUMBER
+            )
+        """)
+
+    def _watermark(self, cursor):
+        cursor.execute(f'SELECT MAX(DATE) FROM {self.table}')
+        return cursor.fetchone()[0]
+
+    # Rebuild the touched days in one transaction; full=True rebuilds the whole table
+    def refresh(self, full=False):
+        with self._lock, get_pool().cursor() as cursor:
+            started = time.monotonic()
+            self._create(cursor)
+            watermark = None if full else self._watermark(cursor)
+
+            insert = f"""
+                INSERT INTO {self.table} (COUNTRY_REGION, PROVINCE_STATE, CASE_TYPE, DATE, CASES)
+                SELECT COUNTRY_REGION, PROVINCE_STATE, CASE_TYPE, DATE, MAX(CASES)
+                FROM {self.source}
+            """
+            group_by = ' GROUP BY COUNTRY_REGION, PROVINCE_STATE, CASE_TYPE, DATE'
+            cursor.execute('BEGIN')
+            try:
+                if watermark is None:
+                    cursor.execute(f'DELETE FROM {self.table}')
+                    cursor.execute(insert + group_by)
+                else:
+                    start = watermark - datetime.timedelta(days=self.lookback_days)
+                    cursor.execute(f'DELETE FROM {self.table} WHERE DATE >= %s', (start,))
+                    cursor.execute(insert + ' WHERE DATE >= %s' + group_by, (start,))
+                rows = getattr(cursor, 'rowcount', None) or 0
+                cursor.execute('COMMIT')
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+
+            self.watermark = self._watermark(cursor)
+            self.ready = self.watermark is not None
+            self.last_refresh = time.time()
+            self.last_refresh_rows = rows
+            self.last_refresh_seconds = time.monotonic() - started
+            return rows
+
+    # Refresh only when the source table changed; one worker process refreshes, the others skip
+    def refresh_if_changed(self):
+        with get_pool().cursor() as cursor:
+            cursor.execute(DATA_VERSION_QUERY)
+            version = tuple(cursor.fetchone())
+        cache = get_shared_cache()
+        key = f'rollup-version-{self.table}'
+        rows = 0
+        with cache.lock(f'rollup-refresh-{self.table}'):
+            if cache.get(key) != version:
+                rows = self.refresh()
+                cache.set(key, version, ttl=7 * 24 * 3600)
+        if not self.ready:
+            with get_pool().cursor() as cursor:
+                self._create(cursor)
+                self.watermark = self._watermark(cursor)
+            self.ready = self.watermark is not None
+        return rows
+
+    @property
+    def stats(self):
+        return {
+            'ready': int(self.ready),
+            'last_refresh': self.last_refresh,
+            'last_refresh_rows': self.last_refresh_rows,
+            'last_refresh_seconds': self.last_refresh_seconds,
+        }
+
+
+_rollup = None
+_rollup_lock = threading.Lock()
+
+
+def _refresh_loop(rollup, interval):
+    while True:
+        try:
+            rollup.refresh_if_changed()
+        except Exception as e:
+            print(f'Rollup refresh failed: {e}')
+        time.sleep(interval)
+
+
+# Rollup configured in config.json, or None when pages should read JHU_COVID_19 directly
+def get_rollup():
+    global _rollup
+    config = load_config()
+    if not config.get('ROLLUP_ENABLED', False):
+        return None
+    if _rollup is None:
+        with _rollup_lock:
+            if _rollup is None:
+                rollup = DailyRollup(
+                    config.get('ROLLUP_TABLE', 'JHU_COVID_19_DAILY'),
+                    lookback_days=config.get('ROLLUP_LOOKBACK_DAYS', 3),
+                )
+                # Built in the background, pages read the raw table until the first refresh is done
+                threading.Thread(target=_refresh_loop, args=(rollup, config.get('ROLLUP_REFRESH_INTERVAL', 600)),
+                                 name='rollup-refresh', daemon=True).start()
+                _rollup = rollup
+    return _rollup
+
+
+# Table the daily MAX(CASES) queries should read
+def daily_table():
+    rollup = get_rollup()
+    return rollup.table if rollup is not None and rollup.ready else SOURCE_TABLE
+
+
+if __name__ == '__main__':
+    # python rollup.py  -> rebuild the configured rollup from scratch
+    target = DailyRollup(load_config().get('ROLLUP_TABLE', 'JHU_COVID_19_DAILY'))
+    print(f'Rebuilt {target.table} with {target.refresh(full=True)} rows')
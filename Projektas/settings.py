@@ -0,0 +1,24 @@
+import json
+import os
+from functools import lru_cache
+
+CONFIG_PATH = os.environ.get('COVID_CONFIG', 'config.json')
+
+
+# Shared config.json loader for modules used by several pages
+@lru_cache(maxsize=None)
+def load_config():
+    with open(CONFIG_PATH) as f:
+        return json.load(f)
+
+
+# Directory only this user can read or write, for files the app loads back (cache entries, metrics);
+# an existing one owned by someone else or open to others is refused
+def private_directory(path):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.stat(path)
+    if info.st_uid != os.getuid():
+        raise PermissionError(f'{path} belongs to another user')
+    if info.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    return path
@@ -0,0 +1,174 @@
+import functools
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+from settings import load_config, private_directory
+
+
+# Pickled values in a directory shared by every worker process on the host and readable by their user
+# only, since whoever can write an entry runs code in the app when it is loaded. Each file's mtime is
+# set to its expiry, so expired entries (and stale locks and temp files) are removed by a scan of
+# the directory every evict_interval seconds without reading them.
+class FileSystemCache:
+    def __init__(self, directory, default_ttl=300, evict_interval=600):
+        self.directory = directory
+        self.default_ttl = default_ttl
+        self.evict_interval = evict_interval
+        self._next_evict = time.time() + evict_interval
+        self._evict_lock = threading.Lock()
+        private_directory(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires < time.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (ttl or self.default_ttl)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((expires, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.utime(tmp, (expires, expires))
+        os.replace(tmp, self._path(key))
+        if time.time() >= self._next_evict:
+            self._next_evict = time.time() + self.evict_interval
+            threading.Thread(target=self.evict, name='cache-evict', daemon=True).start()
+
+    # Remove expired entries, temp files left by crashed writers and lock files nobody holds
+    def evict(self, stale_after=3600):
+        import fcntl
+
+        if not self._evict_lock.acquire(blocking=False):
+            return 0
+        removed = 0
+        try:
+            now = time.time()
+            for entry in os.scandir(self.directory):
+                try:
+                    mtime = entry.stat().st_mtime
+                    if entry.name.endswith('.lock'):
+                        if mtime > now - stale_after:
+                            continue
+                        with open(entry.path, 'rb') as f:
+                            try:
+                                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                            except BlockingIOError:
+                                continue
+                            os.remove(entry.path)
+                    elif entry.name.endswith('.tmp'):
+                        if mtime > now - stale_after:
+                            continue
+                        os.remove(entry.path)
+                    elif mtime < now:
+                        os.remove(entry.path)
+                    else:
+                        continue
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        finally:
+            self._evict_lock.release()
+        return removed
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    # Exclusive lock so only one worker computes a missing key
+    def lock(self, key):
+        import fcntl
+
+        class _Lock:
+            def __enter__(lock):
+                lock.f = open(self._path(key) + '.lock', 'wb')
+                fcntl.flock(lock.f, fcntl.LOCK_EX)
+
+            def __exit__(lock, *exc):
+                fcntl.flock(lock.f, fcntl.LOCK_UN)
+                lock.f.close()
+
+        return _Lock()
+
+
+# Same interface on a Redis-compatible server
+class RedisCache:
+    def __init__(self, url, default_ttl=300, prefix='covid:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.default_ttl = default_ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        data = self.client.get(self.prefix + key)
+        return pickle.loads(data) if data is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+                        ex=int(ttl or self.default_ttl))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def lock(self, key):
+        return self.client.lock(self.prefix + key + ':lock', timeout=600, blocking_timeout=600)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_shared_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = load_config()
+                ttl = config.get('CACHE_DEFAULT_TTL', 300)
+                if config.get('CACHE_REDIS_URL'):
+                    _cache = RedisCache(config['CACHE_REDIS_URL'], default_ttl=ttl)
+                else:
+                    directory = config.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'covid-dashboard-cache'))
+                    _cache = FileSystemCache(directory, default_ttl=ttl,
+                                             evict_interval=config.get('CACHE_EVICT_INTERVAL', 600))
+    return _cache
+
+
+def cache_key(namespace, args, kwargs):
+    digest = hashlib.sha1(repr((args, sorted(kwargs.items()))).encode()).hexdigest()
+    return f'{namespace}-{digest}'
+
+
+# Memoize a function in the shared cache; a missing key is computed by one worker while the others wait
+def memoize(namespace, ttl=None):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            cache = get_shared_cache()
+            key = cache_key(namespace, args, kwargs)
+            value = cache.get(key)
+            if value is not None:
+                return value
+            with cache.lock(key):
+                value = cache.get(key)
+                if value is None:
+                    value = fn(*args, **kwargs)
+                    if value is not None:
+                        cache.set(key, value, ttl)
+            return value
+        return wrapper
+    return decorator
@@ -0,0 +1,251 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from settings import load_config
+from shared_cache import get_shared_cache
+from snowflake_pool import get_pool
+
+SOURCE_TABLE = 'JHU_COVID_19'
+# Changes whenever rows are added, the data version compared by the caches and the rollup
+DATA_VERSION_QUERY = f'SELECT MAX(DATE), COUNT(*) FROM {SOURCE_TABLE}'
+MANIFEST = 'manifest.json'
+
+
+# Local columnar mirror of JHU_COVID_19 stored as compressed Parquet parts. Every worker process
+# reads the same folder: manifest.json lists the current parts, syncs and compactions run one at a
+# time under a shared-cache lock, and compacted parts are only deleted retire_after seconds after
+# they left the manifest, so queries of other workers still reading them finish.
+class LocalSnapshot:
+    def __init__(self, path, compact_after=20, retire_after=600):
+        self.path = path
+        self.compact_after = compact_after
+        self.retire_after = retire_after
+        self.last_sync = None
+        self.last_sync_rows = 0
+        self.last_sync_seconds = None
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # (manifest file stat, manifest) and (parts, MAX(DATE)), both derived from the files on disk
+        self._manifest = (None, None)
+        self._max_date = (None, None)
+
+    def _lock_key(self):
+        return 'snapshot-' + hashlib.sha1(os.path.abspath(self.path).encode()).hexdigest()
+
+    def _read_manifest(self):
+        path = os.path.join(self.path, MANIFEST)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # folder written before the manifest existed
+            parts = sorted(glob.glob(os.path.join(self.path, '*.parquet')))
+            return {'parts': [os.path.basename(part) for part in parts], 'retired': {}}
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self._manifest[0] != key:
+            with open(path) as f:
+                self._manifest = (key, json.load(f))
+        return self._manifest[1]
+
+    def _write_manifest(self, manifest):
+        tmp = os.path.join(self.path, f'{MANIFEST}.{uuid.uuid4().hex[:8]}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def _parts(self):
+        return [os.path.join(self.path, name) for name in self._read_manifest()['parts']]
+
+    def _connection(self):
+        # DuckDB connections are not shared between threads, each thread gets its own view,
+        # rebuilt whenever another sync or compaction (in any process) changed the parts
+        local = self._local
+        parts = self._parts()
+        if getattr(local, 'parts', None) != parts:
+            import duckdb
+
+            conn = duckdb.connect()
+            if parts:
+                conn.execute(f"CREATE VIEW {SOURCE_TABLE} AS SELECT * FROM read_parquet("
+                             f"{parts!r}, union_by_name = true)")
+            local.conn = conn
+            local.parts = parts
+        return local.conn
+
+    def is_empty(self):
+        return not self._parts()
+
+    # True once there is data to answer queries from
+    @property
+    def ready(self):
+        return not self.is_empty()
+
+    def max_date(self):
+        parts = self._parts()
+        if self._max_date[0] != parts:
+            value = None
+            if parts:
+                _, rows = self.query(f'SELECT MAX(DATE) FROM {SOURCE_TABLE}')
+                value = rows[0][0]
+            self._max_date = (parts, value)
+        return self._max_date[1]
+
+    # Answer a dashboard query locally; Snowflake style %s placeholders become DuckDB ones
+    def query(self, query, params=None):
+        if self.is_empty():
+            raise RuntimeError(f'Local snapshot in {self.path} has no data, run a sync first')
+        if params:
+            query = query.replace('%s', '?')
+        cursor = self._connection().execute(query, params or [])
+        columns = [desc[0] for desc in cursor.description]
+        return columns, cursor.fetchall()
+
+    # Same as query() but returns the result as an Arrow table
+    def query_arrow(self, query, params=None):
+        if self.is_empty():
+            raise RuntimeError(f'Local snapshot in {self.path} has no data, run a sync first')
+        if params:
+            query = query.replace('%s', '?')
+        return self._connection().execute(query, params or []).fetch_arrow_table()
+
+    # Memory-mapped Arrow table of the whole snapshot for vectorized pandas work
+    def read_table(self, columns=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        tables = [pq.read_table(part, columns=columns, memory_map=True) for part in self._parts()]
+        # parts written by different syncs may differ in integer width or nullability
+        return pa.concat_tables(tables, promote_options='permissive') if tables else None
+
+    # Pull only rows newer than the stored max DATE and append them as a new part. One process
+    # syncs at a time, the others then start from the MAX(DATE) it left on disk.
+    def sync(self):
+        with self._lock, get_shared_cache().lock(self._lock_key()):
+            return self._sync()
+
+    def _sync(self):
+        import pyarrow.parquet as pq
+
+        from export import widen_schema
+
+        started = time.monotonic()
+        last_date = self.max_date()
+        query = f'SELECT * FROM {SOURCE_TABLE}'
+        params = None
+        if last_date is not None:
+            query += ' WHERE DATE > %s'
+            params = (last_date,)
+
+        name = f'part-{time.strftime("%Y%m%d%H%M%S")}-{uuid.uuid4().hex[:8]}.parquet'
+        part = os.path.join(self.path, name)
+        tmp = part + '.tmp'
+        writer = None
+        rows = 0
+        try:
+            with get_pool().cursor() as cursor:
+                cursor.execute(query, params)
+                for batch in cursor.fetch_arrow_batches():
+                    # later batches can come back with narrower or wider integers than the first
+                    if writer is None:
+                        writer = pq.ParquetWriter(tmp, widen_schema(batch.schema), compression='zstd')
+                    writer.write_table(batch.cast(writer.schema))
+                    rows += batch.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if rows:
+            os.replace(tmp, part)
+            manifest = self._read_manifest()
+            self._write_manifest({'parts': manifest['parts'] + [name], 'retired': manifest['retired']})
+            if len(self._parts()) > self.compact_after:
+                self._compact()
+        elif os.path.exists(tmp):
+            os.remove(tmp)
+        self._remove_retired()
+
+        self.last_sync = time.time()
+        self.last_sync_rows = rows
+        self.last_sync_seconds = time.monotonic() - started
+        return rows
+
+    # Merge every part into one; the old parts stay on disk until retire_after has passed
+    def _compact(self):
+        import pyarrow.parquet as pq
+
+        manifest = self._read_manifest()
+        table = self.read_table()
+        name = f'part-{time.strftime("%Y%m%d%H%M%S")}-{uuid.uuid4().hex[:8]}-compacted.parquet'
+        tmp = os.path.join(self.path, name + '.tmp')
+        pq.write_table(table, tmp, compression='zstd')
+        os.replace(tmp, os.path.join(self.path, name))
+        retired = dict(manifest['retired'], **{old: time.time() for old in manifest['parts']})
+        self._write_manifest({'parts': [name], 'retired': retired})
+
+    def _remove_retired(self):
+        manifest = self._read_manifest()
+        retired = {}
+        for name, at in manifest['retired'].items():
+            if at > time.time() - self.retire_after:
+                retired[name] = at
+                continue
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+        if retired != manifest['retired']:
+            self._write_manifest({'parts': manifest['parts'], 'retired': retired})
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+# First sync right away, then every interval; a failed sync is retried within a minute
+def _sync_loop(snapshot, interval):
+    while True:
+        try:
+            snapshot.sync()
+            delay = interval
+        except Exception as e:
+            print(f'Snapshot sync failed: {e}')
+            delay = min(interval, 60)
+        time.sleep(delay)
+
+
+def is_offline():
+    return bool(load_config().get('SNAPSHOT_OFFLINE', False))
+
+
+# Snapshot configured in config.json, or None when the app should query Snowflake directly.
+# Online, the snapshot is synced in the background and only used once it holds data, so a slow
+# or failing first sync never blocks or breaks the dashboard.
+def get_snapshot():
+    global _snapshot
+    config = load_config()
+    path = config.get('SNAPSHOT_PATH')
+    if not path:
+        return None
+    if _snapshot is None:
+        with _snapshot_lock:
+            if _snapshot is None:
+                snapshot = LocalSnapshot(path)
+                if not is_offline():
+                    interval = config.get('SNAPSHOT_SYNC_INTERVAL', 3600)
+                    threading.Thread(target=_sync_loop, args=(snapshot, interval),
+                                     name='snapshot-sync', daemon=True).start()
+                _snapshot = snapshot
+    if _snapshot.ready or is_offline():
+        return _snapshot
+    return None
+
+
+if __name__ == '__main__':
+    # python snapshot.py  -> one incremental sync of the configured snapshot
+    target = LocalSnapshot(load_config()['SNAPSHOT_PATH'])
+    print(f'Synced {target.sync()} new rows into {target.path}')
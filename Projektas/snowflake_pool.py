@@ -0,0 +1,237 @@
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import TracedConnection, connect_seconds
+from settings import load_config
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class _PooledConnection:
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+# Thread-safe pool of Snowflake sessions shared by every page callback
+class SnowflakePool:
+    def __init__(self, connect, size=4, timeout=10.0, max_idle=300.0, max_lifetime=3600.0,
+                 ping_after=60.0, user_errors=None):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        # errors caused by the query itself, the session is still usable after them
+        self._user_errors = user_errors if user_errors is not None else _snowflake_user_errors()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self.stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'in_use': 0,
+        }
+
+    def _check_fork(self):
+        # Sessions must not be shared with a forked worker process
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def _acquire_slot(self):
+        if self._slots.acquire(blocking=False):
+            return
+        self._count('waits')
+        started = time.monotonic()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        self._count('wait_seconds', time.monotonic() - started)
+        if not acquired:
+            self._count('timeouts')
+            raise PoolTimeout(f'No Snowflake connection available after {self.timeout}s '
+                              f'(pool size {self.size})')
+
+    def _is_usable(self, entry):
+        now = time.monotonic()
+        if now - entry.last_used > self.max_idle or now - entry.created_at > self.max_lifetime:
+            return False
+        if _is_closed(entry.conn):
+            return False
+        if now - entry.last_used > self.ping_after:
+            try:
+                with entry.conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                    cursor.fetchone()
+            except Exception:
+                return False
+        return True
+
+    def _checkout(self):
+        self._check_fork()
+        self._acquire_slot()
+        try:
+            while True:
+                try:
+                    entry = self._idle.get_nowait()
+                except queue.Empty:
+                    started = time.monotonic()
+                    entry = _PooledConnection(self._connect())
+                    connect_seconds.observe(time.monotonic() - started)
+                    self._count('created')
+                    break
+                if self._is_usable(entry):
+                    break
+                self._discard(entry)
+        except BaseException:
+            self._slots.release()
+            raise
+        self._count('checkouts')
+        self._count('in_use')
+        return entry
+
+    def _discard(self, entry):
+        self._count('recycled')
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+
+    def _release(self, entry, broken=False, reuse=True):
+        self._count('in_use', -1)
+        if broken or not reuse or _is_closed(entry.conn):
+            self._discard(entry)
+        else:
+            entry.last_used = time.monotonic()
+            self._idle.put(entry)
+        self._slots.release()
+
+    # reuse=False closes the session afterwards instead of returning it to the pool
+    @contextmanager
+    def connection(self, reuse=True):
+        entry = self._checkout()
+        try:
+            yield TracedConnection(entry.conn)
+        except BaseException as e:
+            self._release(entry, broken=not isinstance(e, self._user_errors), reuse=reuse)
+            raise
+        self._release(entry, reuse=reuse)
+
+    @contextmanager
+    def cursor(self, reuse=True):
+        with self.connection(reuse) as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def close(self):
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(entry)
+
+
+def _is_closed(conn):
+    is_closed = getattr(conn, 'is_closed', None)
+    return bool(is_closed()) if callable(is_closed) else False
+
+
+def _snowflake_user_errors():
+    try:
+        from snowflake.connector.errors import ProgrammingError
+    except ImportError:
+        return ()
+    return (ProgrammingError,)
+
+
+def connect_from_config(config):
+    # Imported on first connection so the connector does not slow down app startup
+    import snowflake.connector
+
+    return snowflake.connector.connect(
+        user=config['SF_USER'],
+        password=config['SF_PASSWORD'],
+        account=config['SF_ACCOUNT'],
+        warehouse=config['SF_WAREHOUSE'],
+        database=config['SF_DATABASE'],
+        schema=config['SF_SCHEMA']
+    )
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# Process-wide pool built from config.json
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                config = load_config()
+                _pool = SnowflakePool(
+                    lambda: connect_from_config(config),
+                    size=config.get('SF_POOL_SIZE', 4),
+                    timeout=config.get('SF_POOL_TIMEOUT', 10.0),
+                    max_idle=config.get('SF_POOL_MAX_IDLE', 300.0),
+                    max_lifetime=config.get('SF_POOL_MAX_LIFETIME', 3600.0),
+                    ping_after=config.get('SF_POOL_PING_AFTER', 60.0),
+                )
+    return _pool
+
+
+def set_pool(pool):
+    global _pool
+    with _pool_lock:
+        _pool = pool
+
+
+_sql_pool = None
+
+
+# Separate pool for the SQL page: a user's USE, ALTER SESSION or open BEGIN must not reach the
+# dashboard's sessions, and long ad-hoc queries must not take its slots. Sessions are used once
+# (connection(reuse=False)), the pool only bounds how many run at a time.
+def get_sql_pool():
+    global _sql_pool
+    if _sql_pool is None:
+        with _pool_lock:
+            if _sql_pool is None:
+                config = load_config()
+                _sql_pool = SnowflakePool(
+                    lambda: connect_from_config(config),
+                    size=config.get('SQL_POOL_SIZE', 4),
+                    timeout=config.get('SQL_POOL_TIMEOUT', 10.0),
+                )
+    return _sql_pool
+
+
+def set_sql_pool(pool):
+    global _sql_pool
+    with _pool_lock:
+        _sql_pool = pool
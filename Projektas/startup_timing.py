@@ -0,0 +1,33 @@
+import threading
+import time
+from contextlib import contextmanager
+
+_started = time.perf_counter()
+_lock = threading.Lock()
+phases = []
+
+
+# Record how long one boot phase took, e.g. `with timed('import pages'):`
+@contextmanager
+def timed(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started, started - _started)
+
+
+def record(name, seconds, offset=None):
+    with _lock:
+        phases.append((name, seconds, offset))
+
+
+# Breakdown of boot time, slowest phases first
+def report():
+    with _lock:
+        rows = sorted(phases, key=lambda phase: phase[1], reverse=True)
+    lines = [f'Startup timing ({time.perf_counter() - _started:.2f}s since first import):']
+    for name, seconds, offset in rows:
+        at = f' (started at +{offset:.2f}s)' if offset is not None else ''
+        lines.append(f'  {name:<40} {seconds:8.3f}s{at}')
+    return '\n'.join(lines)
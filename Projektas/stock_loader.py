@@ -0,0 +1,102 @@
+import threading
+
+import pandas as pd
+
+from settings import load_config
+
+STOCK_FIELDS = (
+    'Close_BioNTech', 'Close_Moderna', 'Close_Johnson & Johnson', 'Close_Inovio Pharmaceuticals',
+    'Close_Sinovac', 'Close_Sinopharm', 'Close_Novavax', 'Close_Astrazeneca',
+)
+
+
+# Keeps the Stocks collection as a local date-indexed frame and only pulls newer documents on refresh
+class StockLoader:
+    def __init__(self, collection, fields=STOCK_FIELDS, batch_size=5000):
+        self.collection = collection
+        self.fields = fields
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._frame = None
+        self._last_date = None
+        self._indexed = False
+
+    def ensure_index(self):
+        if not self._indexed:
+            try:
+                self.collection.create_index('Date')
+            except Exception as e:
+                # read-only users cannot create indexes, incremental queries still work without it
+                print(f'Could not create Date index on {self.collection.name}: {e}')
+            self._indexed = True
+
+    # Columns are filled straight from the cursor, no list of documents is kept
+    def _read(self, query):
+        projection = {'_id': 0, 'Date': 1}
+        projection.update({field: 1 for field in self.fields})
+        cursor = self.collection.find(query, projection, batch_size=self.batch_size).sort('Date', 1)
+
+        names = ('Date',) + tuple(self.fields)
+        columns = {name: [] for name in names}
+        appenders = [(name, columns[name].append) for name in names]
+        for document in cursor:
+            for name, append in appenders:
+                append(document.get(name))
+
+        if columns['Date']:
+            self._last_date = columns['Date'][-1]
+        frame = pd.DataFrame(columns)
+        frame['Date'] = pd.to_datetime(frame['Date'])
+        return frame.set_index('Date').astype('float64')
+
+    # Current frame, fetching only documents with Date after the last one seen
+    def refresh(self):
+        with self._lock:
+            self.ensure_index()
+            if self._frame is None:
+                self._frame = self._read({})
+            else:
+                new_rows = self._read({'Date': {'$gt': self._last_date}})
+                if len(new_rows):
+                    self._frame = pd.concat([self._frame, new_rows])
+            return self._frame
+
+    def frame(self):
+        return self._frame if self._frame is not None else self.refresh()
+
+    # Per-period averages, minimums and maximums computed by MongoDB, unit is day, week or month
+    def summary(self, unit='day', start=None, end=None):
+        match = {}
+        if start is not None:
+            match['$gte'] = start
+        if end is not None:
+            match['$lte'] = end
+
+        group = {'_id': {'$dateTrunc': {'date': {'$toDate': '$Date'}, 'unit': unit}}}
+        for field in self.fields:
+            group[f'{field}_avg'] = {'$avg': f'${field}'}
+            group[f'{field}_min'] = {'$min': f'${field}'}
+            group[f'{field}_max'] = {'$max': f'${field}'}
+
+        pipeline = [{'$match': {'Date': match}}] if match else []
+        pipeline += [{'$group': group}, {'$sort': {'_id': 1}}]
+        rows = list(self.collection.aggregate(pipeline, batchSize=self.batch_size))
+        frame = pd.DataFrame(rows).rename(columns={'_id': 'Date'})
+        return frame.set_index('Date') if len(frame) else frame
+
+
+_loader = None
+_loader_lock = threading.Lock()
+
+
+def get_stock_loader():
+    global _loader
+    if _loader is None:
+        with _loader_lock:
+            if _loader is None:
+                from pymongo import MongoClient
+
+                config = load_config()
+                client = MongoClient(f"mongodb+srv://{config['MONGO_USERNAME']}:{config['MONGO_PASSWORD']}@{config['MONGO_CLUSTER']}/?retryWrites=true&w=majority")
+                _loader = StockLoader(client['Covid']['Stocks'])
+    return _loader
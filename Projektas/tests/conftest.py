@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the app's modules are imported flat, as when running from Projektas
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,26 @@
+from query_cache import is_cacheable, normalize_sql
+
+
+def test_whitespace_and_keyword_case_share_a_key():
+    assert normalize_sql("SELECT *  FROM t WHERE a = 'X'") == normalize_sql("select * from t where a='X';")
+
+
+def test_quoted_literals_keep_their_case():
+    assert normalize_sql("SELECT * FROM t WHERE a = 'X'") != normalize_sql("SELECT * FROM t WHERE a = 'x'")
+    assert normalize_sql('SELECT "Col" FROM t') != normalize_sql('SELECT "COL" FROM t')
+
+
+def test_dollar_quoted_literals_keep_their_case_and_spacing():
+    assert normalize_sql('SELECT $$Hello  World$$') == 'select $$Hello  World$$'
+    assert normalize_sql('SELECT $$ABC$$') != normalize_sql('SELECT $$abc$$')
+    assert normalize_sql("SELECT $$it's -- not a comment$$ FROM t") == "select $$it's -- not a comment$$ from t"
+
+
+def test_comments_are_dropped():
+    assert normalize_sql('SELECT 1 -- one\n/* two */') == normalize_sql('select 1')
+
+
+def test_only_reads_are_cacheable():
+    assert is_cacheable(' -- note\nSELECT 1')
+    assert not is_cacheable("DELETE FROM t WHERE a = 'select'")
+    assert not is_cacheable('$$select$$; DROP TABLE t')
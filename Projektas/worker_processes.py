@@ -0,0 +1,29 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Imported once by the fork server, its forks start with them loaded. None of them start threads on import.
+PRELOAD = ['numpy', 'statsmodels.tsa.arima.model', 'sklearn.cluster', 'forecasting', 'clustering']
+
+
+# Process pool forked from a single-threaded fork server: forking the app itself from a background
+# thread, while the comment writer, pool pings and refresh loops run, can deadlock the children
+def process_pool(max_workers=None):
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(PRELOAD)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+
+# True inside a pool worker, already while it imports the main module again (as __mp_main__) so that
+# import can skip the app's background jobs. gunicorn workers are plain forks named MainProcess.
+def in_worker_process():
+    return multiprocessing.current_process().name != 'MainProcess'
+
+
+# Shuts a pool down without waiting for it: queued calls are cancelled and its processes, possibly
+# stuck in a fit that will never return, are terminated
+def discard_pool(pool):
+    # shutdown() forgets the processes, so they are collected first
+    processes = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()